@@ -1,43 +1,34 @@
 import cv2
 import numpy as np
 import random
-import math
-import os
 
 from keras.layers import Conv2D, Input, concatenate, multiply, subtract, Lambda
 from keras import optimizers
 from keras.models import Model
 from keras.activations import relu 
+from pairing import pair_files
+from sequence import image_sequence, image_shard_sequence, haze_sequence
+from batching import predict_images, predict_tiled
 
-def load_data(data_files,label_files, height, width):
-    
-    data = []
-    label = []
-    
+# distance in pixels over which an input pixel affects the output: the 3, 5,
+# 7 and 3 convolutions chained through the concatenations
+RECEPTIVE_RADIUS = 7
+
+def samples(data_path, label_path, data_files, pairs, height, width):
+    '''
+    (hazy, clear) uint8 image pairs of data_files, resized to height * width,
+    for the training Sequences (sequence.image_sequence)
+    '''
     for data_file in data_files:
         hazy_image = cv2.imread(data_path + "/" + data_file)
-        label_file = label_files[label_files.index(data_file[0:4] + data_file[-4:])] # This is subject to modification depending on the file names of data_files.
+        label_file = pairs[data_file]
         clear_image = cv2.imread(label_path + "/" + label_file)
         
         if hazy_image.shape != (height, width, 3):
             hazy_image = cv2.resize(hazy_image, (width, height), interpolation = cv2.INTER_AREA)
             clear_image = cv2.resize(clear_image, (width, height), interpolation = cv2.INTER_AREA)
         
-        data.append(hazy_image)
-        label.append(clear_image)
-    
-    data = np.asarray(data) / 255.0
-    label = np.asarray(label) / 255.0
-    
-    return data, label
-
-def get_batch(data_files, label_files, batch_size, height, width):
-   
-    while 1:
-        for i in range(0, len(data_files), batch_size):
-            x, y = load_data(data_files[i : i+batch_size], label_files, height, width)
-            
-            yield x, y
+        yield hazy_image, clear_image
 
 def aodmodel():
     input_image = Input(shape = (None, None, 3), name = 'input')
@@ -56,29 +47,60 @@ def aodmodel():
     model = Model(inputs = input_image, outputs = out_image)
     return model
 
-def train_model(data_path, label_path, weights_path, lr=0.001, batch_size=32, p_train=0.8, width=320, height=240, nb_epochs=15):
+def train_model(data_path, label_path, weights_path, lr=0.001, batch_size=32, p_train=0.8, width=320, height=240, nb_epochs=15,
+                shard_path=None, workers=4, max_queue_size=10, depth_path=None, copies=1):
     '''
     p_train : proportion of training data
+    workers : number of threads decoding batches ahead of the training steps
+    max_queue_size : number of batches decoded ahead
+    shard_path : folder for uint8 shards of the decoded and resized training
+                 and validation images, written on the first run and read
+                 memory-mapped on every epoch; None decodes the images on
+                 every epoch
+    depth_path : folder of depth maps named like the clear images, which
+                 data_path then holds; hazy inputs are synthesized from them
+                 at load time (see synthetic.py) and label_path is unused
+    copies : number of differently hazed copies of each clear image per
+             epoch with depth_path
     '''
     model = aodmodel()
     model.summary()
     sgd = optimizers.SGD(lr, clipvalue=0.1, momentum=0.9, decay=0.0001, nesterov=False)
     model.compile(optimizer = sgd, loss = 'mean_squared_error')
     
-    data_files = os.listdir(data_path) 
-    label_files = os.listdir(label_path)
+    if depth_path is None:
+        pairs = pair_files(data_path, label_path, 'ITS')  # naming rule of the dataset, see pairing.RULES
+    else:
+        pairs = pair_files(data_path, depth_path, 'same')
+    data_files = list(pairs)
     random.seed(100)  # ensure we have the same shuffled data every time
     random.shuffle(data_files)  
     x_train = data_files[0: round(len(data_files) * p_train)]
     x_val =  data_files[round(len(data_files) * p_train) : len(data_files)]
     
-    steps_per_epoch = math.ceil(len(x_train) / batch_size)
-    steps = math.ceil(len(x_val) / batch_size)
+    buffers = max_queue_size + workers + 2
+    if depth_path is not None:
+        train_batches = haze_sequence(data_path, depth_path, x_train, pairs, batch_size, height, width, 'clear',
+                                      copies, buffers = buffers)
+        val_batches = haze_sequence(data_path, depth_path, x_val, pairs, batch_size, height, width, 'clear',
+                                    1, False, buffers)
+    elif shard_path is None:
+        train_batches = image_sequence(samples, data_path, label_path, x_train, pairs, batch_size, height, width,
+                                       buffers = buffers)
+        val_batches = image_sequence(samples, data_path, label_path, x_val, pairs, batch_size, height, width,
+                                     False, buffers)
+    else:
+        train_batches = image_shard_sequence(samples, data_path, label_path, x_train, pairs,
+                                             shard_path + '/train', batch_size, height, width, buffers = buffers)
+        val_batches = image_shard_sequence(samples, data_path, label_path, x_val, pairs,
+                                           shard_path + '/val', batch_size, height, width, False, buffers)
+    steps_per_epoch = len(train_batches)
+    steps = len(val_batches)
     
-    model.fit_generator(generator = get_batch(x_train, label_files, batch_size, height, width), 
+    model.fit_generator(generator = train_batches, 
                         steps_per_epoch=steps_per_epoch, epochs = nb_epochs, validation_data = 
-                        get_batch(x_val, label_files, batch_size, height, width), validation_steps = steps,
-                        use_multiprocessing=True, 
+                        val_batches, validation_steps = steps,
+                        workers = workers, max_queue_size = max_queue_size, use_multiprocessing=False, 
                         shuffle=False, initial_epoch=0)
     
     model.save_weights(weights_path + '/aodnet.h5')
@@ -90,17 +112,37 @@ def Load_model(weights):
     model.load_weights(weights)
     return model
 
-def usemodel(model, hazy_image):
+def usemodel(model, hazy_image, tile = None, blend = 8):
+    '''
+    tile    run the network on tile * tile pixel tiles (batching.predict_tiled)
+            with RECEPTIVE_RADIUS pixels of context each, so memory is bounded
+            by the tile size on large images; None runs the whole frame
+    blend   half width of the cross-faded band across tile seams
+    '''
     
     height = hazy_image.shape[0]
     width = hazy_image.shape[1]
     channel = hazy_image.shape[2]
-    hazy_input = np.reshape(hazy_image, (1, height, width, channel)) / 255.0
-    clear_ = model.predict(hazy_input)
+    if tile is None:
+        hazy_input = np.reshape(hazy_image, (1, height, width, channel)) / 255.0
+        clear_ = model.predict(hazy_input)
+    else:
+        clear_ = predict_tiled(model, hazy_image, tile, RECEPTIVE_RADIUS, blend)
     clear_image = np.floor(np.reshape(clear_, (height, width, channel)) * 255.0).astype(np.uint8)
     
     return clear_image
 
+def usemodel_batch(model, images, max_batch = 8, multiple = 1):
+    '''
+    usemodel on a list of images, run as real batches of at most max_batch
+    images of the same shape. With multiple > 1 images are edge padded to a
+    multiple of it so that more of them share a shape; the padding is
+    cropped off again. Returns the dehazed images in input order.
+    '''
+    clear_ = predict_images(model, images, max_batch, multiple)
+    
+    return [np.floor(c * 255.0).astype(np.uint8) for c in clear_]
+
 if __name__ =="__main__":
     
     ''' 
@@ -108,7 +150,8 @@ if __name__ =="__main__":
     
     Usage: 
         1. modify the paths
-        2. potentially change a line in load_data (see above)
+        2. potentially change the naming rule pair_files gets in train_model,
+           which pairs hazy images with their labels (see pairing.RULES)
         3. run this file
         4. visualize the images using:
             cv2.imshow('nameofwindow', hazy_image)
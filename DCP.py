@@ -1,83 +1,421 @@
 # -*- coding: utf-8 -*-
 # borrowed heavily from https://github.com/joyeecheung/dark-channel-prior-dehazing
 import cv2
+import threading
+import tracemalloc
 import numpy as np
 import guidedfilter
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+def _running_min(a, w):
+    '''
+    van Herk/Gil-Werman running minimum over axis 0 of a.
+    Returns the a.shape[0] - w + 1 minima of every window of length w,
+    with a constant cost per element whatever the size of w.
+    '''
+    n = a.shape[0]
+    nout = n - w + 1
+    nblocks = -(-n // w)
+    # pad to a whole number of blocks; the tail is never read for valid windows
+    a = np.pad(a, ((0, nblocks * w - n),) + ((0, 0),) * (a.ndim - 1), 'edge')
+    blocks = a.reshape((nblocks, w) + a.shape[1:])
+    prefix = np.minimum.accumulate(blocks, axis=1).reshape(a.shape)
+    suffix = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(a.shape)
+
+    return np.minimum(suffix[:nout], prefix[w - 1:w - 1 + nout])
+
+def min_filter(I, w):
+    '''
+    Separable w * w minimum filter of a single channel image, edge padded so
+    the output has the same shape as I.
+    '''
+    M, N = I.shape
+    padded = np.pad(I, ((w // 2, w // 2), (w // 2, w // 2)), 'edge')
+    rows = _running_min(padded, w)[:M]
+    
+    return _running_min(rows.T, w)[:N].T
+
 def get_dark_channel(I, w):
     
-    M, N, _ = I.shape
-    padded = np.pad(I, ((w // 2, w // 2), (w // 2, w // 2), (0, 0)), 'edge')
-    darkch = np.zeros((M, N))
-    for i, j in np.ndindex(darkch.shape):
-        darkch[i, j] = np.min(padded[i:i + w, j:j + w, :])  # CVPR09, eq.5
+    return min_filter(np.min(I, axis=2), w)  # CVPR09, eq.5
+
+def top_indices(values, k, order = None):
+    '''
+    Indices of the k largest values, in linear time. Ties at the threshold go
+    to the lowest index, or to the lowest key in order if given, so the choice
+    is the same as a stable sort and does not depend on how pixels were split.
+    '''
+    n = values.size
+    if k >= n:
+        return np.arange(n)
+    
+    v = np.partition(values, n - k)[n - k]
+    above = np.flatnonzero(values > v)
+    ties = np.flatnonzero(values == v)
+    if order is not None:
+        ties = ties[np.argsort(order[ties], kind='stable')]
     
-    return darkch
+    return np.concatenate((above, ties[:k - above.size]))
 
-def get_atmosphere(I, darkch, p):
+def get_atmosphere(I, darkch, p, stride = 1):
+    '''
+    Brightest colour of I among the p brightest pixels of darkch (CVPR09, 4.4).
+    The top pixels are picked with a linear time partition instead of a sort.
+    stride > 1 estimates A from every stride-th row and column only, for very
+    large frames.
+    '''
+    if stride > 1:
+        I = I[::stride, ::stride]
+        darkch = darkch[::stride, ::stride]
     
     M, N = darkch.shape
     flatI = I.reshape(M * N, 3)
     flatdark = darkch.ravel() #arranged horizontally
-    searchidx = (-flatdark).argsort()[:round(M * N * p)]
+    searchidx = top_indices(flatdark, max(round(M * N * p), 1))
  
     return np.max(flatI.take(searchidx, axis=0), axis=0)
 
+class AtmosphereReservoir(object):
+    '''
+    Streaming get_atmosphere for images seen tile by tile: keeps the k pixels
+    with the brightest dark channel so far, with their colours, so memory is
+    bounded by k and not by the image. Ties are broken by pixel position as in
+    get_atmosphere, so the result does not depend on the tiling or on the
+    order tiles are added in. add() may be called from several threads.
+    '''
+    
+    def __init__(self, k):
+        
+        self.k = max(k, 1)
+        self.dark = np.empty(0)
+        self.index = np.empty(0, np.int64)
+        self.colours = np.empty((0, 3))
+        self.lock = threading.Lock()
+    
+    def add(self, I, darkch, index):
+        '''
+        index holds the flat position of each pixel of darkch in the image.
+        '''
+        dark, index = darkch.ravel(), index.ravel()
+        keep = top_indices(dark, self.k, index)
+        dark, index = dark[keep], index[keep]
+        colours = I.reshape(-1, 3)[keep]
+        
+        with self.lock:
+            dark = np.concatenate((self.dark, dark))
+            index = np.concatenate((self.index, index))
+            colours = np.concatenate((self.colours, colours))
+            keep = top_indices(dark, self.k, index)
+            self.dark, self.index, self.colours = dark[keep], index[keep], colours[keep]
+    
+    def atmosphere(self):
+        
+        return np.max(self.colours, axis=0)
+
+def tiles(M, N, tile, halo):
+    '''
+    Cover an M * N image with tile * tile blocks, or tile[0] * tile[1] if
+    tile is a pair. Yields the slices of each block and of the block grown by
+    halo on every side (clipped to the image), and the slices of the block
+    within the grown one.
+    '''
+    th, tw = tile if isinstance(tile, tuple) else (tile, tile)
+    for y0 in range(0, M, th):
+        for x0 in range(0, N, tw):
+            y1, x1 = min(y0 + th, M), min(x0 + tw, N)
+            Y0, X0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            Y1, X1 = min(y1 + halo, M), min(x1 + halo, N)
+            yield ((slice(y0, y1), slice(x0, x1)),
+                   (slice(Y0, Y1), slice(X0, X1)),
+                   (slice(y0 - Y0, y1 - Y0), slice(x0 - X0, x1 - X0)))
+
+def strip_rows(M, workers, halo):
+    '''
+    Rows per strip to share M rows among workers threads when each strip is
+    grown by halo rows on both sides: an equal share, but at least 4 * halo
+    rows, so the halo recomputes at most half a strip. Short images thus get
+    fewer strips than workers, and one strip of M rows if M <= 4 * halo.
+    '''
+    return min(M, max(-(-M // workers), 4 * halo))
+
 def get_transmission(I, A, darkch, omega, w):
     
-    return 1 - omega * get_dark_channel(I / A, w)  # CVPR09, eq.12
+    # min over channels of I / A, without building the M * N * 3 quotient
+    normed = I[:, :, 0] / A[0]
+    for c in (1, 2):
+        np.minimum(normed, I[:, :, c] / A[c], out=normed)
+    
+    return 1 - omega * min_filter(normed, w)  # CVPR09, eq.12
 
-def get_radiance(I, A, t):
+def get_radiance(I, A, t, tmin=0.1, L=256, out=None, dtype=np.float64, workers=1, rows=64):
+    '''
+    uint8 scene radiance clip((I - A) / max(t, tmin) + A, 0, L - 1) of the
+    image I for the atmospheric light A and the single-channel transmission
+    t, broadcast over the channels (CVPR09, eq.16). Shared by DCP, DehazeNet
+    and MSCNN.
+    
+    The image is processed rows rows at a time, computed in dtype and cast
+    into the uint8 out, allocated if None, so the only temporaries are one
+    strip per thread. workers > 1 runs the strips on a pool of threads.
+    '''
+    M, N = t.shape
+    if out is None:
+        out = np.empty((M, N, I.shape[2]), np.uint8)
     
-    tiledt = np.zeros_like(I)  # tiled to M * N * 3
-    tiledt[:, :, 0] = tiledt[:, :, 1] = tiledt[:, :, 2] = t
-    return (I - A) / tiledt + A  # CVPR09, eq.16
+    def strip(start):
+        block = slice(start, start + rows)
+        J = np.subtract(I[block], A, dtype=dtype)
+        J /= np.maximum(t[block], tmin, dtype=dtype)[:, :, None]
+        J += A
+        np.clip(J, 0, L - 1, out=J)
+        out[block] = J  # truncates, as astype(np.uint8)
+    
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            for _ in pool.map(strip, range(0, M, rows)):
+                pass
+    else:
+        for start in range(0, M, rows):
+            strip(start)
+    
+    return out
 
-def dehaze_1(im, tmin = 0.1, w = 15, p = 0.001,
-           omega = 0.95, r = 40, eps = 1e-3, L = 256):
+class DCPDehazer(object):
     '''
+    Dark channel prior dehazing with fixed parameters, for many frames.
+    
+    tmin   lower bound of the refined transmission
+    Amax   upper bound of the atmospheric light, None for no bound
     p      percent of pixels
-    W      window size
+    w      window size
     omega  before transmission
+    r      radius of the guided filter
+    eps    epsilon of the guided filter
     L      highest pixel value
+    s      subsampling ratio of the (fast) guided filter, 1 is exact
+    dtype  np.float64, or np.float32 to halve the working memory; float32
+           output differs from float64 by at most 1 grey level
+    workers  number of threads; with more than 1, dehaze() splits each frame
+           into up to that many row strips (see dehaze_tiled and strip_rows),
+           which NumPy runs in parallel as it releases the GIL in its loops
+    A_stride  estimate the atmospheric light from every A_stride-th row and
+           column only (see get_atmosphere), for very large frames
+    sizes  number of frame sizes whose float buffers are kept, the least
+           recently used dropped first; 0 keeps none, for a single frame
+    
+    The kept buffers are reused, so a video of one resolution allocates its
+    working memory only once; each size kept holds about 165 bytes per pixel
+    in float64. Peak memory, buffers included, is about 230 bytes per pixel
+    in float64 and 115 in float32 (see peak_memory), most of it the 13 maps
+    the guided filter averages; only float32 halves it. An instance is not
+    thread safe; use one per thread.
     '''
-    I = np.asarray(im, dtype=np.float64)
     
-    m, n, _ = I.shape
-    Idark = get_dark_channel(I, w)
-    A = get_atmosphere(I, Idark, p)
-    rawt = get_transmission(I, A, Idark, omega, w)
-    normI = (I - I.min()) / (I.max() - I.min())  # normalize I
-    refinedt = guidedfilter.guided_filter(normI, rawt, r, eps)
-    refinedt = np.maximum(refinedt, tmin)
-    clear_image = get_radiance(I, A, refinedt)
+    def __init__(self, tmin = 0.1, Amax = None, w = 15, p = 0.001, omega = 0.95,
+                 r = 40, eps = 1e-3, L = 256, s = 1, dtype = np.float64, workers = 1,
+                 A_stride = 1, sizes = 1):
+        
+        self.tmin = tmin
+        self.Amax = Amax
+        self.w = w
+        self.p = p
+        self.omega = omega
+        self.r = r
+        self.eps = eps
+        self.L = L
+        self.s = s
+        self.dtype = dtype
+        self.workers = workers
+        self.A_stride = A_stride
+        self.sizes = sizes
+        self.workspaces = OrderedDict()
+    
+    def workspace(self, M, N):
+        '''
+        Buffers for M * N frames, or None if no sizes are kept.
+        '''
+        if self.sizes < 1:
+            return None
+        if (M, N) in self.workspaces:
+            self.workspaces.move_to_end((M, N))
+        else:
+            while len(self.workspaces) >= self.sizes:
+                self.workspaces.popitem(last = False)
+            self.workspaces[(M, N)] = {
+                'I': np.empty((M, N, 3), self.dtype),
+                'normI': np.empty((M, N, 3), self.dtype),
+                'guided': guidedfilter.workspace(M, N, self.dtype, self.s, self.r)}
+        
+        return self.workspaces[(M, N)]
+    
+    def dehaze(self, im):
+        
+        M, N, _ = im.shape
+        rows = strip_rows(M, self.workers, self.halo())
+        if rows < M:
+            return self.dehaze_tiled(im, tile = (rows, N))
+        
+        work = self.workspace(M, N)
+        if work is None:
+            I = im.astype(self.dtype)
+        else:
+            I = work['I']
+            np.copyto(I, im)
+        
+        Idark = get_dark_channel(I, self.w)
+        A = get_atmosphere(I, Idark, self.p, self.A_stride)
+        
+        return self.recover(I, A, I.min(), I.max(), Idark, work)
+    
+    def halo(self):
+        '''
+        Reach in pixels of one output pixel into the input: 2r + w // 2, plus
+        2s when the guided filter is subsampled (see dehaze_tiled).
+        '''
+        return 2 * self.r + self.w // 2 + (2 * self.s if self.s > 1 else 0)
+    
+    def recover(self, I, A, lo, hi, Idark = None, work = None):
+        '''
+        uint8 radiance of I, for the atmospheric light A and the range
+        [lo, hi] of the image I belongs to. work is a workspace for the
+        normalized image and the guided filter, allocated if None.
+        '''
+        if self.Amax is not None:
+            A = np.minimum(A, self.Amax)
+        rawt = get_transmission(I, A, Idark, self.omega, self.w)
+        normI = np.subtract(I, lo, out=None if work is None else work['normI'])
+        normI /= hi - lo  # normalize I
+        refinedt = guidedfilter.guided_filter(normI, rawt, self.r, self.eps, self.s,
+                                              None if work is None else work['guided'])
+        
+        return get_radiance(I, A, refinedt, self.tmin, self.L, dtype=self.dtype)
     
-    return np.maximum(np.minimum(clear_image, L - 1), 0).astype(np.uint8) 
+    def dehaze_many(self, frames):
+        '''
+        Dehaze an iterable of frames lazily, yielding one result per frame.
+        '''
+        for frame in frames:
+            yield self.dehaze(frame)
+    
+    def dehaze_tiled(self, src, dst = None, tile = 1024):
+        '''
+        Dehaze an image too large for memory, tile by tile, in two passes.
+        
+        src   M * N * 3 array, typically a read-only np.memmap
+        dst   M * N * 3 uint8 array for the result, e.g. a writable np.memmap;
+              allocated in memory if None
+        tile  side of the square tiles, or a (rows, columns) pair
+        
+        The first pass streams the dark channel through an AtmosphereReservoir,
+        on the same A_stride grid as dehaze(), and finds the range of the
+        image. The second pass dehazes each tile grown by halo() pixels, 2r +
+        w // 2, enough for the dark channel and both box filters of the
+        guided filter, so with s = 1 the result matches dehaze() on the whole
+        image; with s > 1 the halo adds 2s for the subsampling. Tiles run on
+        self.workers threads. Peak memory is bounded
+        by workers * (tile + 2 * halo)^2 pixels.
+        '''
+        M, N, _ = src.shape
+        if dst is None:
+            dst = np.empty((M, N, 3), np.uint8)
+        stride = self.A_stride
+        reservoir = AtmosphereReservoir(round(-(-M // stride) * -(-N // stride) * self.p))
+        
+        def dark(blocks):
+            core, grown, inner = blocks
+            I = np.asarray(src[grown], dtype=self.dtype)
+            Idark = get_dark_channel(I, self.w)[inner]
+            # the pixels of the block on the global stride grid
+            y0, x0 = -core[0].start % stride, -core[1].start % stride
+            index = np.add.outer(np.arange(core[0].start + y0, core[0].stop, stride) * N,
+                                 np.arange(core[1].start + x0, core[1].stop, stride))
+            reservoir.add(I[inner][y0::stride, x0::stride], Idark[y0::stride, x0::stride], index)
+            
+            return I.min(), I.max()
+        
+        def radiance(blocks):
+            core, grown, inner = blocks
+            I = np.asarray(src[grown], dtype=self.dtype)
+            dst[core] = self.recover(I, A, lo, hi)[inner]
+        
+        halo = self.halo()
+        with ThreadPoolExecutor(self.workers) as pool:
+            ranges = list(pool.map(dark, tiles(M, N, tile, self.w // 2)))
+            lo = min(r[0] for r in ranges)
+            hi = max(r[1] for r in ranges)
+            A = reservoir.atmosphere()
+            for _ in pool.map(radiance, tiles(M, N, tile, halo)):
+                pass
+        
+        return dst
+    
+    def dehaze_npy(self, src_path, dst_path, tile = 1024):
+        '''
+        Dehaze the image in the .npy file src_path into a new .npy file at
+        dst_path, both memory-mapped, so peak memory is set by tile and not
+        by the image size.
+        '''
+        src = np.load(src_path, mmap_mode = 'r')
+        dst = np.lib.format.open_memmap(dst_path, mode = 'w+', dtype = np.uint8,
+                                        shape = src.shape)
+        self.dehaze_tiled(src, dst, tile)
+        dst.flush()
+        
+        return dst_path
 
-def dehaze_2(im, tmin = 0.2, Amax = 220, w = 15, p = 0.001,
-           omega = 0.95, r = 40, eps = 1e-3, L = 256):
+def dehaze_1(im, tmin = 0.1, w = 15, p = 0.001, omega = 0.95, r = 40,
+           eps = 1e-3, L = 256, s = 1, dtype = np.float64, workers = 1, A_stride = 1):
     '''
     p      percent of pixels
     W      window size
     omega  before transmission
     L      highest pixel value
+    s      subsampling ratio of the (fast) guided filter, 1 is exact
+    dtype  np.float64 or np.float32, see DCPDehazer
+    workers  number of threads, see DCPDehazer
+    A_stride  subsampling of the atmospheric light estimate, see DCPDehazer
+    '''
+    return DCPDehazer(tmin, None, w, p, omega, r, eps, L, s, dtype, workers, A_stride, 0).dehaze(im)
+
+def dehaze_2(im, tmin = 0.2, Amax = 220, w = 15, p = 0.001, omega = 0.95, r = 40,
+           eps = 1e-3, L = 256, s = 1, dtype = np.float64, workers = 1, A_stride = 1):
+    '''
+    p      percent of pixels
+    W      window size
+    omega  before transmission
+    L      highest pixel value
+    s      subsampling ratio of the (fast) guided filter, 1 is exact
+    dtype  np.float64 or np.float32, see DCPDehazer
+    workers  number of threads, see DCPDehazer
+    A_stride  subsampling of the atmospheric light estimate, see DCPDehazer
     Possible modification:
         tmin = 0.2
         Amax = 220
     '''
-    I = np.asarray(im, dtype=np.float64)
-    
-    m, n, _ = I.shape
-    Idark = get_dark_channel(I, w)
-    A = get_atmosphere(I, Idark, p)
-    A = np.minimum(A, Amax)
-    rawt = get_transmission(I, A, Idark, omega, w)
-    normI = (I - I.min()) / (I.max() - I.min())  # normalize I
-    refinedt = guidedfilter.guided_filter(normI, rawt, r, eps)
-    refinedt = np.maximum(refinedt, tmin)
-    clear_image = get_radiance(I, A, refinedt)
+    return DCPDehazer(tmin, Amax, w, p, omega, r, eps, L, s, dtype, workers, A_stride, 0).dehaze(im)
+
+def peak_memory(im, **params):
+    '''
+    Peak memory in bytes per pixel of dehazing the image im once with
+    DCPDehazer(**params), in float64 and in float32, as traced by
+    tracemalloc, and the largest difference in grey levels of the float32
+    result from the float64 one. Returns ({dtype name: bytes per pixel},
+    difference).
+    '''
+    peaks = {}
+    results = []
+    for dtype in (np.float64, np.float32):
+        tracemalloc.start()
+        results.append(DCPDehazer(dtype = dtype, **params).dehaze(im))
+        peaks[dtype.__name__] = tracemalloc.get_traced_memory()[1] / (im.shape[0] * im.shape[1])
+        tracemalloc.stop()
+        print('%s: %.0f bytes per pixel' % (dtype.__name__, peaks[dtype.__name__]))
+    difference = int(np.abs(results[0].astype(int) - results[1]).max())
+    print('float32 differs from float64 by at most %d grey levels' % difference)
     
-    return np.maximum(np.minimum(clear_image, L - 1), 0).astype(np.uint8) 
+    return peaks, difference
 
 if __name__ =="__main__":
     
@@ -85,4 +423,5 @@ if __name__ =="__main__":
     im = cv2.imread(images_path)
     im_dehaze_1 = dehaze_1(im)
     im_dehaze_2 = dehaze_2(im)
+    peak_memory(im)
     
\ No newline at end of file
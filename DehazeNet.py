@@ -2,55 +2,123 @@
 import cv2
 import numpy as np
 import random
-import os
-import math
+import shards
 import keras.backend as K
 
 from keras.layers import Conv2D, Input, concatenate, MaxPooling2D, Activation
 from keras import optimizers, initializers
 from keras.models import Model
+from DCP import get_atmosphere
+from pairing import pair_files
+from sequence import SampleSequence, ShardSequence, RandomShardSequence
+from synthetic import HazeGenerator
+from DCP import get_radiance as recover_radiance
 from guidedfilter import guided_filter
 from keras.engine.topology import Layer
 from keras.callbacks import LearningRateScheduler
 from keras.utils.generic_utils import get_custom_objects
 
-def load_data(data_files,label_files, patch_size = 16):
+# distance in pixels from the edge of the output over which the zero padding
+# of the 'same' convolutions reaches in: 3 for the 7 * 7 conv3; windowed
+# inference (quantization.QuantizedModel) keeps this much context
+RECEPTIVE_RADIUS = 3
+
+def image_patches(image, patch_size = 16):
+    '''
+    The non-overlapping patch_size * patch_size patches of image, whose
+    height and width must be multiples of patch_size, in row-major order, as
+    one n * patch_size * patch_size (* channel) array made by block reshapes
+    rather than patch by patch.
+    '''
+    rows = image.shape[0] // patch_size
+    cols = image.shape[1] // patch_size
+    blocks = image.reshape((rows, patch_size, cols, patch_size) + image.shape[2:]).swapaxes(1, 2)
     
-    data = []
-    label = []
+    return blocks.reshape((rows * cols, patch_size, patch_size) + image.shape[2:])
+
+def patch_means(trans_patches):
+    '''
+    n * 1 * 1 * 1 labels of n transmission patches: the mean of each patch
+    '''
+    return trans_patches.reshape(len(trans_patches), -1).mean(axis = 1).reshape(-1, 1, 1, 1)
+
+def load_patches(data_path, label_path, data_files, pairs, patch_size = 16):
+    '''
+    uint8 hazy patches and transmission patches of all data_files, each image
+    and its transmission map shrunk to a multiple of patch_size first
+    '''
+    hazy_patches = []
+    trans_patches = []
     
     for data_file in data_files:
         hazy_image = cv2.imread(data_path + "/" + data_file)
-        height = hazy_image.shape[0]
-        width = hazy_image.shape[1]
-        if height % patch_size != 0:
-            height = height // patch_size * patch_size
-        if width % patch_size != 0:
-            width = width // patch_size * patch_size
+        height = hazy_image.shape[0] // patch_size * patch_size
+        width = hazy_image.shape[1] // patch_size * patch_size
         
         hazy_image = cv2.resize(hazy_image, (width, height), interpolation = cv2.INTER_AREA)
-        label_file = label_files[label_files.index(data_file.partition('.')[0][:-2] + data_file[-4:])]  #This is subject to modification depending on the file names of data_files.
+        label_file = pairs[data_file]
         trans_map = cv2.imread(label_path + "/" + label_file, 0)
         trans_map = cv2.resize(trans_map, (width, height), interpolation = cv2.INTER_AREA)
-        for i in random.sample(range(height // patch_size), height // patch_size):
-            for j in random.sample(range(width // patch_size),width // patch_size):
-                hazy_patch = hazy_image[(i * 16) : (16 * i + 16), (j * 16) : (j * 16 + 16), :]
-                trans_patch = trans_map[(i * 16) : (16 * i + 16), (j * 16) : (j * 16 + 16),]
-                data.append(hazy_patch)
-                label.append(np.mean(trans_patch))
+        hazy_patches.append(image_patches(hazy_image, patch_size))
+        trans_patches.append(image_patches(trans_map, patch_size))
     
-    data = np.asarray(data)  / 255.0
-    label = np.asarray(label).reshape(len(label), 1, 1, 1) / 255.0
+    return np.concatenate(hazy_patches), np.concatenate(trans_patches)
+
+def samples(data_path, label_path, data_files, pairs, patch_size = 16):
+    '''
+    (hazy patch, transmission patch) uint8 pairs of load_patches, for
+    shards.write_shards; the label is the mean of the transmission patch
+    '''
+    for data_file in data_files:
+        hazy_patches, trans_patches = load_patches(data_path, label_path, [data_file], pairs, patch_size)
+        for pair in zip(hazy_patches, trans_patches):
+            yield pair
+
+def get_sequence(data_path, label_path, data_files, pairs, batch_size, shuffle = True, buffers = 16):
+    '''
+    keras Sequence of the patches of batch_size images per batch, labelled
+    with their mean transmission and decoded by the loader threads of
+    fit_generator; the images are reshuffled every epoch if shuffle, so each
+    batch holds the patches of batch_size random scenes
+    '''
+    return SampleSequence(data_files, lambda files: load_patches(data_path, label_path, files, pairs),
+                          batch_size, patch_means, shuffle, buffers = buffers)
+
+def get_shard_sequence(data_path, label_path, data_files, pairs, shard_path, batch_size, shuffle = True, buffers = 16):
+    '''
+    get_sequence read from preprocessed patch shards in shard_path, written
+    there first unless they already hold data_files. As in get_sequence, a
+    batch holds as many patches as batch_size images on average; if shuffle,
+    they are drawn uniformly from the whole dataset, anew every epoch.
+    '''
+    index = shards.ensure_shards(samples(data_path, label_path, data_files, pairs),
+                                 shard_path, files = list(data_files))
+    patches = batch_size * max(1, index['count'] // max(1, len(data_files)))
     
-    return data, label
+    if shuffle:
+        return RandomShardSequence(shard_path, patches, patch_means, buffers = buffers)
+    return ShardSequence(shard_path, patches, patch_means, False, buffers = buffers)
 
-def get_batch(data_files, label_files, batch_size):
-   
-    while 1:
-        for i in range(0, len(data_files), batch_size):
-            x, y = load_data(data_files[i : i+batch_size], label_files)
-            
-            yield x, y
+def get_haze_sequence(clear_path, depth_path, clear_files, pairs, batch_size, height = 480, width = 640, copies = 1,
+                      shuffle = True, buffers = 16, patch_size = 16):
+    '''
+    keras Sequence of the patches of images hazed on the fly from the clear
+    images in clear_path and their depth maps in depth_path (see
+    synthetic.py), labelled with the mean transmission of each patch. The
+    images are resized to height * width, rounded down to multiples of
+    patch_size. Every clear image appears copies times per epoch, each time
+    with new random haze; without shuffle, as for validation, each image is
+    hazed the same way every epoch.
+    '''
+    haze = HazeGenerator(clear_path, depth_path, pairs, height // patch_size * patch_size,
+                         width // patch_size * patch_size, 'trans', fixed = not shuffle)
+    
+    def load(files):
+        hazy, trans = haze(files)
+        return (np.concatenate([image_patches(h, patch_size) for h in hazy]),
+                np.concatenate([image_patches(t[:, :, 0], patch_size) for t in trans]))
+    
+    return SampleSequence(list(clear_files) * copies, load, batch_size, patch_means, shuffle, buffers = buffers)
 
 def BReLu(x):
     '''
@@ -58,34 +126,25 @@ def BReLu(x):
     '''
     return K.minimum(K.maximum(0., x), 1.)
 
-def get_airlight(hazy_image, trans_map, p):
-    M, N = trans_map.shape
-    flat_image = hazy_image.reshape(M*N, 3)
-    flat_trans = trans_map.ravel()
-    searchidx = (-flat_trans).argsort()[:round(M * N * p)]
+def get_airlight(hazy_image, trans_map, p, stride = 1):
     
-    return np.max(flat_image.take(searchidx, axis=0), axis = 0)
+    return get_atmosphere(hazy_image, trans_map, p, stride)
 
 def get_radiance(hazy_image, airlight, trans_map, L):
-    tiledt = np.ones_like(hazy_image) * 0.1
-    tiledt[:,:,0] = tiledt[:,:,1] = tiledt[:,:,2] = trans_map
-    min_t = np.ones_like(hazy_image) * 0.2
-    t = np.maximum(tiledt, min_t)
-    
-    hazy_image = hazy_image.astype(int)
-    airlight = airlight.astype(int)
-    airlight = np.minimum(airlight, 220)
     
-    clear_ = (hazy_image - airlight) / t + airlight
-    clear_image = np.maximum(np.minimum(clear_, L-1), 0).astype(np.uint8)
+    airlight = np.minimum(airlight, 220).astype(int)
     
-    return clear_image
+    return recover_radiance(hazy_image, airlight, trans_map, 0.2, L)
 
 class MaxoutConv2D(Layer):
     """
     Convolution Layer followed by Maxout activation as described 
     in https://arxiv.org/abs/1505.03540.
     
+    All output_dim * nb_features filter maps come from one fused convolution
+    with a single kernel, which is then reshaped to (output_dim, nb_features)
+    groups and maxed over each group.
+    
     Parameters
     ----------
     
@@ -97,28 +156,46 @@ class MaxoutConv2D(Layer):
     
     def __init__(self, kernel_size, output_dim, nb_features=4, padding='valid', use_bias = True, **kwargs):
         
-        self.kernel_size = kernel_size
+        self.kernel_size = tuple(kernel_size)
         self.output_dim = output_dim
         self.nb_features = nb_features
         self.padding = padding
         self.use_bias = use_bias
         super(MaxoutConv2D, self).__init__(**kwargs)
 
-    def call(self, x):
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name = 'kernel',
+                                      shape = self.kernel_size + (input_shape[3], self.output_dim * self.nb_features),
+                                      initializer = initializers.random_normal(mean=0.,stddev=0.001),
+                                      trainable = True)
+        if self.use_bias:
+            self.bias = self.add_weight(name = 'bias',
+                                        shape = (self.output_dim * self.nb_features,),
+                                        initializer = 'zeros',
+                                        trainable = True)
+        super(MaxoutConv2D, self).build(input_shape)
 
-        output = None
-        for _ in range(self.output_dim):
-            
-            conv_out = Conv2D(self.nb_features, self.kernel_size, padding=self.padding, use_bias = self.use_bias, kernel_initializer=initializers.random_normal(mean=0.,stddev=0.001))(x)            
-            maxout_out = K.max(conv_out, axis=-1, keepdims=True)
+    def call(self, x):
 
-            if output is not None:
-                output = K.concatenate([output, maxout_out], axis=-1)
+        conv_out = K.conv2d(x, self.kernel, padding = self.padding)
+        if self.use_bias:
+            conv_out = K.bias_add(conv_out, self.bias)
+        
+        # filter maps u * nb_features ... (u + 1) * nb_features - 1 make output u
+        shape = K.shape(conv_out)
+        groups = K.reshape(conv_out, (shape[0], shape[1], shape[2], self.output_dim, self.nb_features))
+        
+        return K.max(groups, axis=-1)
 
-            else:
-                output = maxout_out
+    def get_config(self):
+        config = {'kernel_size': self.kernel_size,
+                  'output_dim': self.output_dim,
+                  'nb_features': self.nb_features,
+                  'padding': self.padding,
+                  'use_bias': self.use_bias}
+        base_config = super(MaxoutConv2D, self).get_config()
         
-        return output
+        return dict(list(base_config.items()) + list(config.items()))
 
     def compute_output_shape(self, input_shape):
         input_height= input_shape[1]
@@ -153,7 +230,20 @@ def DehazeNet(): #### carefully inspect the weights! this and all other networks
     
     return model
 
-def train_model(data_path, label_path, weights_path, lr=0.005, momentum=0.9, decay=5e-4, p_train = 0.8, batch_size = 100, nb_epochs = 50):
+def train_model(data_path, label_path, weights_path, lr=0.005, momentum=0.9, decay=5e-4, p_train = 0.8, batch_size = 100, nb_epochs = 50,
+                shard_path = None, workers = 4, max_queue_size = 10, depth_path = None, copies = 1):
+    '''
+    shard_path : folder for uint8 shards of the training and validation
+                 patches, written on the first run and read memory-mapped on
+                 every epoch; None decodes the images on every epoch
+    workers : number of threads decoding batches ahead of the training steps
+    max_queue_size : number of batches decoded ahead
+    depth_path : folder of depth maps named like the clear images, which
+                 data_path then holds; hazy inputs are synthesized from them
+                 at load time (see synthetic.py) and label_path is unused
+    copies : number of differently hazed copies of each clear image per
+             epoch with depth_path
+    '''
     
     def scheduler(epoch):
         if epoch % 10 == 0 and epoch != 0:
@@ -168,23 +258,40 @@ def train_model(data_path, label_path, weights_path, lr=0.005, momentum=0.9, dec
     sgd = optimizers.SGD(lr, momentum, decay, nesterov=False)
     dehazenet.compile(optimizer = sgd, loss = 'mean_squared_error')
                         
-    data_files = os.listdir(data_path) 
-    label_files = os.listdir(label_path)    
+    if depth_path is None:
+        pairs = pair_files(data_path, label_path, 'ITS-trans')  # naming rule of the dataset, see pairing.RULES
+    else:
+        pairs = pair_files(data_path, depth_path, 'same')
+    data_files = list(pairs)
     
     random.seed(100)  # ensure we have the same shuffled data every time
     random.shuffle(data_files) 
     x_train = data_files[0: round(len(data_files) * p_train)]
     x_val =  data_files[round(len(data_files) * p_train) : len(data_files)]
     
-    steps_per_epoch = math.ceil(len(x_train) / batch_size)
-    steps = math.ceil(len(x_val) / batch_size)
+    buffers = max_queue_size + workers + 2
+    if depth_path is not None:
+        train_batches = get_haze_sequence(data_path, depth_path, x_train, pairs, batch_size, copies = copies,
+                                          buffers = buffers)
+        val_batches = get_haze_sequence(data_path, depth_path, x_val, pairs, batch_size, shuffle = False,
+                                        buffers = buffers)
+    elif shard_path is None:
+        train_batches = get_sequence(data_path, label_path, x_train, pairs, batch_size, buffers = buffers)
+        val_batches = get_sequence(data_path, label_path, x_val, pairs, batch_size, False, buffers)
+    else:
+        train_batches = get_shard_sequence(data_path, label_path, x_train, pairs,
+                                           shard_path + '/train', batch_size, buffers = buffers)
+        val_batches = get_shard_sequence(data_path, label_path, x_val, pairs,
+                                         shard_path + '/val', batch_size, False, buffers)
+    steps_per_epoch = len(train_batches)
+    steps = len(val_batches)
         
     reduce_lr = LearningRateScheduler(scheduler)
    
-    dehazenet.fit_generator(generator = get_batch(x_train, label_files, batch_size), 
+    dehazenet.fit_generator(generator = train_batches, 
                         steps_per_epoch=steps_per_epoch, epochs = nb_epochs, validation_data = 
-                        get_batch(x_val, label_files, batch_size), validation_steps = steps,
-                        use_multiprocessing=True, 
+                        val_batches, validation_steps = steps,
+                        workers = workers, max_queue_size = max_queue_size, use_multiprocessing=False, 
                         shuffle=False, initial_epoch=0, callbacks = [reduce_lr])
     dehazenet.save_weights(weights_path + '/dehazenet.h5')
     print('dehazenet generated')
@@ -196,35 +303,87 @@ def Load_model(weights):
     dehazenet.load_weights(weights)
     return dehazenet
     
-def usemodel(dehazenet, hazy_image):
+def dense_transmission(dehazenet, hazy_image, stride = 1):
+    '''
+    Per-pixel transmission map of hazy_image from a single forward pass of the
+    fully convolutional network. It turns a 16 * 16 input into one value, so
+    the image is edge padded by 7 pixels at the top and left and 8 at the
+    bottom and right to keep its size. This only approximates running each
+    16 * 16 window alone, as the network was trained: over the whole image
+    the zero padded conv1-3 see the real neighbours of the window instead of
+    zeros, so each value depends on a neighbourhood of about 22 * 22 pixels
+    and differs from that of the isolated patch.
+    
+    stride  > 1 runs the network on the image shrunk by stride and upsamples
+            the map back, about stride^2 times less compute for a coarser map
+    '''
+    height = hazy_image.shape[0]
+    width = hazy_image.shape[1]
+    
+    if stride > 1:
+        hazy_image = cv2.resize(hazy_image, (max(width // stride, 1), max(height // stride, 1)),
+                                interpolation = cv2.INTER_AREA)
+    padded = np.pad(hazy_image, ((7, 8), (7, 8), (0, 0)), 'edge')
+    hazy_input = padded[np.newaxis] / 255.0
+    trans_map = dehazenet.predict(hazy_input)[0, :, :, 0]
+    if stride > 1:
+        trans_map = cv2.resize(trans_map, (width, height), interpolation = cv2.INTER_LINEAR)
+    
+    return trans_map.astype(np.float64)
+
+def patch_transmission(dehazenet, hazy_image, patch_size = 16, batch_size = 1024):
+    '''
+    Transmission map made of one value per non-overlapping patch, the way the
+    network was trained. hazy_image must be a multiple of patch_size in size.
+    '''
+    height = hazy_image.shape[0]
+    width = hazy_image.shape[1]
+    rows = height // patch_size
+    cols = width // patch_size
+    
+    hazy_input = image_patches(hazy_image, patch_size) / 255.0
+    trans = dehazenet.predict(hazy_input, batch_size = batch_size)
+    
+    # every pixel of a patch gets the transmission of its patch
+    trans_map = np.empty((height, width))
+    trans_map.reshape(rows, patch_size, cols, patch_size)[...] = trans.reshape(rows, 1, cols, 1)
+    
+    return trans_map
+
+def usemodel(dehazenet, hazy_image, s = 1, batch_size = 1024, dense = False, stride = 1, A_stride = 1):
+    '''
+    s           subsampling ratio of the (fast) guided filter, 1 is exact
+    batch_size  number of 16 * 16 patches per predict batch
+    dense       estimate the transmission of every pixel in one forward pass
+                (dense_transmission) instead of one value per 16 * 16 patch;
+                the image then keeps its size
+    stride      resolution/compute trade-off of the dense mode
+    A_stride    estimate the airlight from every A_stride-th row and column
+                only, for very large frames
+    '''
    
     patch_size = 16
     p = 0.001
     L = 256
     
-    height = hazy_image.shape[0]
-    width = hazy_image.shape[1]
-    channel = hazy_image.shape[2]
-    
-    if height % patch_size != 0:
-        height = height // patch_size * patch_size
-    if width % patch_size != 0:
-        width = width // patch_size * patch_size
+    if dense:
+        trans_map = dense_transmission(dehazenet, hazy_image, stride)
+    else:
+        height = hazy_image.shape[0]
+        width = hazy_image.shape[1]
         
-    hazy_image = cv2.resize(hazy_image, (width, height), interpolation = cv2.INTER_AREA)
-    trans_map = np.zeros((height, width))
-    
-    for i in range(height // patch_size):
-        for j in range(width // patch_size):
-            hazy_patch = hazy_image[(i * 16) : (16 * i + 16), (j * 16) : (j * 16 + 16), :]
-            hazy_input = np.reshape(hazy_patch, (1, patch_size, patch_size, channel)) / 255.0
-            trans = dehazenet.predict(hazy_input)
-            trans_map[(i * 16) : (16 * i + 16), (j * 16) : (j * 16 + 16)] = trans
+        if height % patch_size != 0:
+            height = height // patch_size * patch_size
+        if width % patch_size != 0:
+            width = width // patch_size * patch_size
+            
+        hazy_image = cv2.resize(hazy_image, (width, height), interpolation = cv2.INTER_AREA)
+        trans_map = patch_transmission(dehazenet, hazy_image, patch_size, batch_size)
     
     norm_hazy_image = (hazy_image - hazy_image.min()) / (hazy_image.max() - hazy_image.min())
-    refined_trans_map = guided_filter(norm_hazy_image, trans_map)
+    refined_trans_map = guided_filter(norm_hazy_image, trans_map, s = s)
     
-    Airlight = get_airlight(hazy_image, refined_trans_map, p)
+    Airlight = get_airlight(hazy_image, refined_trans_map, p, A_stride)
     clear_image = get_radiance(hazy_image, Airlight, refined_trans_map, L)
     
     return clear_image
@@ -235,7 +394,8 @@ if __name__ =="__main__":
     
     Usage:
         1. modify the paths
-        2. potentially change a line in load_data (see above)
+        2. potentially change the naming rule pair_files gets in train_model,
+           which pairs hazy images with their labels (see pairing.RULES)
         3. run this file
         4. visualize the images using:
             cv2.imshow('nameofwindow', hazy_image)
@@ -1,18 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import cv2
 import time
+import queue
 import random
+import importlib
+import threading
+import subprocess
 import numpy as np
 
-from MSCNN import usemodel as MSCNN
-from MSCNN import Load_model as load_mscnn
-from DehazeNet import usemodel as DehazeNet
-from DehazeNet import Load_model as load_dehazenet
-from AOD_Net import usemodel as AOD_Net
-from AOD_Net import Load_model as load_aodnet
-from DCP import dehaze_1 as DCP_1
-from DCP import dehaze_2 as DCP_2
+from model_registry import get_model
+from pairing import pair_files
 from skimage.measure import compare_ssim as ssim
 from skimage.measure import compare_psnr as psnr
 
@@ -27,6 +26,62 @@ def SSIM(im1, im2):
         im1 = cv2.resize(im1, (im2.shape[1], im2.shape[0]), interpolation = cv2.INTER_AREA)
     return ssim(im1, im2, multichannel = True, gaussian_weights = True)
 
+# method name: (module, function, model_registry architecture of its network
+# or None). The module, and Keras with it for the networks, is imported on
+# the first call of dehaze with that method only.
+METHODS = {'DCP_1': ('DCP', 'dehaze_1', None),
+           'DCP_2': ('DCP', 'dehaze_2', None),
+           'AOD': ('AOD_Net', 'usemodel', 'AOD'),
+           'AOD-NumPy': ('aod_numpy', 'usemodel', 'AOD-NumPy'),
+           'DehazeNet': ('DehazeNet', 'usemodel', 'DehazeNet'),
+           'MSCNN': ('MSCNN', 'usemodel', 'MSCNN')}
+
+def register_method(name, module, function, architecture = None):
+    
+    METHODS[name] = (module, function, architecture)
+
+def dehaze(method, image, weights = None, **params):
+    '''
+    Dehaze image with one of the METHODS.
+    
+    weights :   weights file of the network, loaded once through model_registry;
+                ignored by DCP
+    params :    further keyword arguments of the method function
+    '''
+    module, function, architecture = METHODS[method]
+    function = getattr(importlib.import_module(module), function)
+    if architecture is None:
+        return function(image, **params)
+    
+    return function(get_model(architecture, weights), image, **params)
+
+def startup_benchmark(method, image_path, weights = None):
+    '''
+    Import Evaluate and dehaze the image at image_path with method in a fresh
+    interpreter. Returns the import time and the time to the first dehazed
+    image in seconds, the peak resident memory in MB, and whether Keras or
+    TensorFlow got imported.
+    '''
+    code = ('import time, resource, sys\n'
+            'start = time.perf_counter()\n'
+            'import cv2, Evaluate\n'
+            'imported = time.perf_counter() - start\n'
+            'Evaluate.dehaze(%r, cv2.imread(%r), %r)\n'
+            'print(imported, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,'
+            ' "keras" in sys.modules or "tensorflow" in sys.modules)\n' % (method, image_path, weights))
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd = os.path.dirname(os.path.abspath(__file__)))
+    import_time, first_image_time, rss, keras = output.split()[-4:]
+    
+    result = {'import_time': float(import_time),
+              'first_image_time': float(first_image_time),
+              'rss': int(rss) / 1024.0,   # ru_maxrss is in kB on Linux
+              'keras': keras == b'True'}
+    print('%s: import %.2f s, first image %.2f s, peak RSS %.0f MB, Keras imported: %s' %
+          (method, result['import_time'], result['first_image_time'], result['rss'], result['keras']))
+    
+    return result
+
 def extract_video_frames(video_path, video_frames_path):
     '''
     Break a video into discrete frames. Return the frames and store them into a folder.
@@ -73,33 +128,115 @@ def frame_to_video(video_path, frame_path, fps = 30, shape = (1280, 720)):
     
     video_writer.release()
     
-def video_dehaze(fps, width, height):
+def stream_dehaze(video_path, dehazed_video_path, dehaze, fps = None, workers = 1,
+                  max_frames = 16, frames_path = None, dehazed_frames_path = None):
+    '''
+    Dehaze a video frame by frame without holding it in memory or on disk.
+    
+    A decoder thread reads frames, workers threads dehaze them and an encoder
+    thread writes them to dehazed_video_path in their original order. At most
+    max_frames frames are in flight at any time, so memory use does not grow
+    with the length of the video. Frames are also stored as JPEG files in
+    frames_path and dehazed_frames_path only if these folders are given.
+    
+    dehaze :    function from a hazy frame to a dehazed frame; it is called
+                from several threads at once if workers > 1
+    fps :       frame rate of the dehazed video, that of the input if None
+    '''
+    cap = cv2.VideoCapture(video_path)
+    fps = fps or cap.get(cv2.CAP_PROP_FPS)
+    slots = threading.Semaphore(max_frames)
+    hazy_frames = queue.Queue()
+    dehazed_frames = queue.Queue()
+    errors = []
+    
+    def decode():
+        frame_count = 0
+        try:
+            while not errors:
+                if not slots.acquire(timeout = 0.1):
+                    continue
+                success, frame = cap.read()
+                if success == False:
+                    break
+                if frames_path is not None:
+                    cv2.imwrite(frames_path + '/frame' + '_%d.jpg' % (frame_count + 1), frame)
+                hazy_frames.put((frame_count, frame))
+                frame_count += 1
+        except Exception as e:
+            errors.append(e)
+        finally:
+            cap.release()
+            for _ in range(workers):
+                hazy_frames.put(None)
+    
+    def work():
+        try:
+            for frame_count, frame in iter(hazy_frames.get, None):
+                dehazed_frames.put((frame_count, dehaze(frame)))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            dehazed_frames.put(None)
+    
+    def encode():
+        video_writer = None
+        pending = {}
+        next_count = 0
+        finished = 0
+        try:
+            while finished < workers:
+                item = dehazed_frames.get()
+                if item is None:
+                    finished += 1
+                    continue
+                pending[item[0]] = item[1]
+                # frames come back out of order; write those that are due
+                while next_count in pending:
+                    frame = pending.pop(next_count)
+                    if video_writer is None:
+                        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+                        video_writer = cv2.VideoWriter(dehazed_video_path, fourcc, fps,
+                                                       (frame.shape[1], frame.shape[0]))
+                    video_writer.write(frame)
+                    if dehazed_frames_path is not None:
+                        cv2.imwrite(dehazed_frames_path + '/dehazed_%d.jpg' % (next_count + 1), frame)
+                    next_count += 1
+                    slots.release()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if video_writer is not None:
+                video_writer.release()
+    
+    threads = [threading.Thread(target = decode), threading.Thread(target = encode)]
+    threads += [threading.Thread(target = work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        raise errors[0]
+
+def video_dehaze(fps = None, workers = 1):
     '''
-    Read a video from video_path, store video frames in video_frames_path; dehaze frames and store dehazed frames in AOD_dehazed_frames_path; then generate a dehazed video and store it in dehazed_video_path.
+    Read a video from video_path, dehaze its frames with AOD-Net and write the dehazed video to dehazed_video_path, streaming frames through memory. Set video_frames_path and AOD_dehazed_frames_path to also store the hazy and dehazed frames.
     
     video path :                file path
-    video_frames_path :         folder path
-    AOD_dehazed_frames_path :   folder path
+    video_frames_path :         folder path, or None
+    AOD_dehazed_frames_path :   folder path, or None
     dehazed_video_path :       file path
     '''
     video_path = ''
-    video_frames_path = ''
-    AOD_dehazed_frames_path = ''
+    video_frames_path = None
+    AOD_dehazed_frames_path = None
     dehazed_video_path = ''
     AOD_Net_Weights = ''
     
-    model_aod = load_aodnet(AOD_Net_Weights)
-    
-    hazy_images = extract_video_frames(video_path, video_frames_path)
-    image_count = 1
-    
-    for hazy_image in hazy_images:
-        AOD_Dehazed = AOD_Net(model_aod, hazy_image)
-        cv2.imwrite(AOD_dehazed_frames_path + '/AOD_%d.jpg' % image_count, AOD_Dehazed)
-        
-        image_count += 1
-    
-    frame_to_video(dehazed_video_path + '/AOD_Dehazed_Video.avi', AOD_dehazed_frames_path, fps, shape = (width, height))
+    stream_dehaze(video_path, dehazed_video_path + '/AOD_Dehazed_Video.avi',
+                  lambda hazy_image: dehaze('AOD', hazy_image, AOD_Net_Weights), fps, workers,
+                  frames_path = video_frames_path, dehazed_frames_path = AOD_dehazed_frames_path)
   
 def compute_psnr_ssim():
     '''
@@ -113,10 +250,6 @@ def compute_psnr_ssim():
     MSCNN_Weights = ''
     DehazeNet_Weights = ''
     
-    model_aod = load_aodnet(AOD_Net_Weights)
-    model_dehazenet = load_dehazenet(DehazeNet_Weights)
-    model_mscnn = load_mscnn(MSCNN_Weights)
-    
     Hazy_Images_Path = ''
     Clear_Images_Path = ''
     DCP_Dehazed_Path_1 = ''
@@ -125,8 +258,8 @@ def compute_psnr_ssim():
     MSCNN_Dehazed_Path = ''
     DehazeNet_Dehazed_Path = ''
     
-    test_data_files = os.listdir(testdata_path)
-    test_label_files = os.listdir(testlabel_path)
+    test_pairs = pair_files(testdata_path, testlabel_path, 'SOTS')  # naming rule of the test set, see pairing.RULES
+    test_data_files = list(test_pairs)
     random.shuffle(test_data_files)
     
     DCP_PSNR = []
@@ -143,15 +276,15 @@ def compute_psnr_ssim():
     image_count = 1
     
     for test_data in test_data_files:
-        test_label = test_label_files[test_label_files.index(test_data[0:4] + test_data[-4:])] # this is subject to change depending on the test set used
+        test_label = test_pairs[test_data]
         hazy_image = cv2.imread(testdata_path + '/' + test_data)
         clear_image = cv2.imread(testlabel_path + '/' + test_label)
         
-        DCP_Dehazed_1 = DCP_1(hazy_image)
-        DCP_Dehazed_2 = DCP_2(hazy_image)
-        AOD_Dehazed = AOD_Net(model_aod, hazy_image)
-        DehazeNet_Dehazed = DehazeNet(model_dehazenet, hazy_image)
-        MSCNN_Dehazed = MSCNN(model_mscnn, hazy_image)
+        DCP_Dehazed_1 = dehaze('DCP_1', hazy_image)
+        DCP_Dehazed_2 = dehaze('DCP_2', hazy_image)
+        AOD_Dehazed = dehaze('AOD', hazy_image, AOD_Net_Weights)
+        DehazeNet_Dehazed = dehaze('DehazeNet', hazy_image, DehazeNet_Weights)
+        MSCNN_Dehazed = dehaze('MSCNN', hazy_image, MSCNN_Weights)
         
         DCP_PSNR.append(PSNR(clear_image, DCP_Dehazed_1))
         DCP_SSIM.append(SSIM(clear_image, DCP_Dehazed_1))
@@ -187,40 +320,42 @@ def run_time():
     MSCNN_Weights = ''
     DehazeNet_Weights = ''
     
-    model_aod = load_aodnet(AOD_Net_Weights)
-    model_dehazenet = load_dehazenet(DehazeNet_Weights)
-    model_mscnn = load_mscnn(MSCNN_Weights)
-    
     images = []
     
     for data_file in data_files:
         im = cv2.imread(data_path + '/' + data_file)
         images.append(im)
     
+    # warm the networks up outside the timed regions
+    shape = images[0].shape[:2]
+    get_model('AOD', AOD_Net_Weights, [shape])
+    get_model('DehazeNet', DehazeNet_Weights, [(1024, 16, 16)])
+    get_model('MSCNN', MSCNN_Weights, [(shape[0] // 2 * 2, shape[1] // 2 * 2)])
+    
     dcp = time.clock()
     for i in range(len(images)):
-        _ = DCP_2(images[i])
+        _ = dehaze('DCP_2', images[i])
     dcp_average = (time.clock() - dcp) / len(images)
     
     print('DCP average time per image: ', dcp_average)
     
     dehazenet = time.clock()
     for i in range(len(images)):
-        _ = DehazeNet(model_dehazenet, images[i])
+        _ = dehaze('DehazeNet', images[i], DehazeNet_Weights)
     dehazenet_average = (time.clock() - dehazenet) / len(images)
     
     print('DehazeNet average time per image: ', dehazenet_average)
     
     mscnn = time.clock()
     for i in range(len(images)):
-        _ = MSCNN(model_mscnn, images[i])
+        _ = dehaze('MSCNN', images[i], MSCNN_Weights)
     mscnn_average = (time.clock() - mscnn) / len(images)
     
     print('MSCNN average time per image: ', mscnn_average)
     
     aod = time.clock()
     for i in range(len(images)):
-        _ = AOD_Net(model_aod, images[i])
+        _ = dehaze('AOD', images[i], AOD_Net_Weights)
     aod_average = (time.clock() - aod) / len(images)
     
     print('AOD average time per image: ', aod_average)
@@ -229,7 +364,7 @@ def run_time():
 if __name__ =="__main__":
     
     dcp_psnr, dcp_ssim, dcp_2_psnr, dcp_2_ssim, aod_psnr, aod_ssim, mscnn_psnr, mscnn_ssim, dehazenet_psnr, dehazenet_ssim = compute_psnr_ssim()
-    #video_dehaze(30,1280,720)
+    #video_dehaze(30)
 
 
 
@@ -1,47 +1,40 @@
 import cv2
 import numpy as np
 import random
-import os
-import math
 import keras.backend as K
 
 from keras.layers import Conv2D, Input, UpSampling2D, concatenate, MaxPooling2D
 from keras import optimizers
 from keras.models import Model
+from DCP import get_atmosphere
+from DCP import get_radiance as recover_radiance
+from pairing import pair_files
+from sequence import image_sequence, image_shard_sequence, haze_sequence
+from batching import predict_images, predict_tiled
 from keras.activations import sigmoid
 from keras.engine.topology import Layer
 from keras.callbacks import LearningRateScheduler
 
-def load_data(data_files,label_files, height, width):
-    
-    data = []
-    label = []
-    
+# distance in pixels over which an input pixel affects the output: the 11, 9,
+# 7 and 5, 3 convolutions of the two scales plus one pixel per pooling level
+RECEPTIVE_RADIUS = 20
+
+def samples(data_path, label_path, data_files, pairs, height, width):
+    '''
+    (hazy image, height * width * 1 transmission map) uint8 pairs of
+    data_files, for the training Sequences (sequence.image_sequence)
+    '''
     for data_file in data_files:
         hazy_image = cv2.imread(data_path + "/" + data_file)
-        label_file = label_files[label_files.index(data_file.partition('.')[0][:-2] + data_file[-4:])] # This is subject to modification depending on the file names of data_files.
+        label_file = pairs[data_file]
         trans_map = cv2.imread(label_path + "/" + label_file, 0)
         
         if hazy_image.shape != (height, width, 3):
             hazy_image = cv2.resize(hazy_image, (width, height), interpolation = cv2.INTER_AREA)
             trans_map = cv2.resize(trans_map, (width, height), interpolation = cv2.INTER_AREA)
-            
-        data.append(hazy_image)
-        label.append(trans_map)
-    
-    data = np.asarray(data)  / 255.0
-    label = np.asarray(label).reshape(len(label), height, width, 1) / 255.0
-    
-    return data, label
+        
+        yield hazy_image, trans_map[:, :, np.newaxis]
 
-def get_batch(data_files, label_files, batch_size, height, width):
-   
-    while 1:
-        for i in range(0, len(data_files), batch_size):
-            x, y = load_data(data_files[i : i+batch_size], label_files, height, width)
-            
-            yield x, y
-            
 class Linear_Comb(Layer):
     '''
     a self defined layer, to linearly combine feature maps from previous layer
@@ -68,29 +61,15 @@ class Linear_Comb(Layer):
     def compute_output_shape(self, input_shape):
         return (input_shape[0], input_shape[1], input_shape[2], self.output_dim)
     
-def get_airlight(hazy_image, trans_map, p):
-    M, N = trans_map.shape
-    flat_image = hazy_image.reshape(M*N, 3)
-    flat_trans = trans_map.ravel()
-    searchidx = (-flat_trans).argsort()[:round(M * N * p)]
+def get_airlight(hazy_image, trans_map, p, stride = 1):
     
-    return np.max(flat_image.take(searchidx, axis=0), axis = 0)
+    return get_atmosphere(hazy_image, trans_map, p, stride)
 
 def get_radiance(hazy_image, airlight, trans_map, L):
     
-    tiledt = np.ones_like(hazy_image) * 0.1
-    tiledt[:,:,0] = tiledt[:,:,1] = tiledt[:,:,2] = trans_map
-    min_t = np.ones_like(hazy_image) * 0.2
-    t = np.maximum(tiledt, min_t)
-    airlight = np.minimum(airlight, 220)
-    
-    hazy_image = hazy_image.astype(int)
-    airlight = airlight.astype(int)
+    airlight = np.minimum(airlight, 220).astype(int)
     
-    clear_ = (hazy_image - airlight) / t + airlight
-    clear_image = np.maximum(np.minimum(clear_, L-1), 0).astype(np.uint8)
-    
-    return clear_image
+    return recover_radiance(hazy_image, airlight, trans_map, 0.2, L)
     
 def MSCNN():
     '''
@@ -126,7 +105,21 @@ def MSCNN():
     return model
 
 def train_model(data_path, label_path, weights_path, lr=0.1, momentum=0.9, decay=5e-4, p_train = 0.8, 
-                width = 320, height = 240, batch_size = 100, nb_epochs = 50):
+                width = 320, height = 240, batch_size = 100, nb_epochs = 50, shard_path = None,
+                workers = 4, max_queue_size = 10, depth_path = None, copies = 1):
+    '''
+    shard_path : folder for uint8 shards of the decoded and resized training
+                 and validation images, written on the first run and read
+                 memory-mapped on every epoch; None decodes the images on
+                 every epoch
+    workers : number of threads decoding batches ahead of the training steps
+    max_queue_size : number of batches decoded ahead
+    depth_path : folder of depth maps named like the clear images, which
+                 data_path then holds; hazy inputs are synthesized from them
+                 at load time (see synthetic.py) and label_path is unused
+    copies : number of differently hazed copies of each clear image per
+             epoch with depth_path
+    '''
     
     def scheduler(epoch):
         if epoch % 10 == 0 and epoch != 0:
@@ -137,25 +130,44 @@ def train_model(data_path, label_path, weights_path, lr=0.1, momentum=0.9, decay
     
     sgd = optimizers.SGD(lr, momentum, decay, nesterov=False)
     
-    data_files = os.listdir(data_path) 
-    label_files = os.listdir(label_path)
+    if depth_path is None:
+        pairs = pair_files(data_path, label_path, 'ITS-trans')  # naming rule of the dataset, see pairing.RULES
+    else:
+        pairs = pair_files(data_path, depth_path, 'same')
+    data_files = list(pairs)
     random.seed(100)  # ensure we have the same shuffled data every time
     random.shuffle(data_files) 
     x_train = data_files[0: round(len(data_files) * p_train)]
     x_val =  data_files[round(len(data_files) * p_train) : len(data_files)]
     
-    steps_per_epoch = math.ceil(len(x_train) / batch_size)
-    steps = math.ceil(len(x_val) / batch_size)
+    buffers = max_queue_size + workers + 2
+    if depth_path is not None:
+        train_batches = haze_sequence(data_path, depth_path, x_train, pairs, batch_size, height, width, 'trans',
+                                      copies, buffers = buffers)
+        val_batches = haze_sequence(data_path, depth_path, x_val, pairs, batch_size, height, width, 'trans',
+                                    1, False, buffers)
+    elif shard_path is None:
+        train_batches = image_sequence(samples, data_path, label_path, x_train, pairs, batch_size, height, width,
+                                       buffers = buffers)
+        val_batches = image_sequence(samples, data_path, label_path, x_val, pairs, batch_size, height, width,
+                                     False, buffers)
+    else:
+        train_batches = image_shard_sequence(samples, data_path, label_path, x_train, pairs,
+                                             shard_path + '/train', batch_size, height, width, buffers = buffers)
+        val_batches = image_shard_sequence(samples, data_path, label_path, x_val, pairs,
+                                           shard_path + '/val', batch_size, height, width, False, buffers)
+    steps_per_epoch = len(train_batches)
+    steps = len(val_batches)
     
     reduce_lr = LearningRateScheduler(scheduler)
     
     mscnn = MSCNN()
     mscnn.summary()
     mscnn.compile(optimizer = sgd, loss = 'mean_squared_error')
-    mscnn.fit_generator(generator = get_batch(x_train, label_files, batch_size, height, width), 
+    mscnn.fit_generator(generator = train_batches, 
                         steps_per_epoch=steps_per_epoch, epochs = nb_epochs, validation_data = 
-                        get_batch(x_val, label_files, batch_size, height, width), validation_steps = steps,
-                        use_multiprocessing=True, 
+                        val_batches, validation_steps = steps,
+                        workers = workers, max_queue_size = max_queue_size, use_multiprocessing=False, 
                         shuffle=False, initial_epoch=0, callbacks = [reduce_lr])
     mscnn.save_weights(weights_path + '/mscnn.h5')
     print('MSCNN generated')
@@ -167,7 +179,15 @@ def Load_model(weights):
     mscnn.load_weights(weights)
     return mscnn
 
-def usemodel(mscnn, hazy_image):
+def usemodel(mscnn, hazy_image, tile = None, blend = 8, A_stride = 1):
+    '''
+    tile    run the network on tile * tile pixel tiles (batching.predict_tiled)
+            with RECEPTIVE_RADIUS pixels of context each, so memory is bounded
+            by the tile size on large images; None runs the whole frame
+    blend   half width of the cross-faded band across tile seams
+    A_stride  estimate the airlight from every A_stride-th row and column
+            only, for very large frames
+    '''
     
     height = hazy_image.shape[0]
     width = hazy_image.shape[1]
@@ -182,21 +202,46 @@ def usemodel(mscnn, hazy_image):
         width = hazy_image.shape[1] // 2 * 2
     
     hazy_image = cv2.resize(hazy_image, (width, height), interpolation = cv2.INTER_AREA)
-    hazy_input = np.reshape(hazy_image, (1, height, width, channel)) / 255.0
-    trans_map = mscnn.predict(hazy_input)
+    if tile is None:
+        hazy_input = np.reshape(hazy_image, (1, height, width, channel)) / 255.0
+        trans_map = mscnn.predict(hazy_input)
+    else:
+        trans_map = predict_tiled(mscnn, hazy_image, tile, RECEPTIVE_RADIUS, blend, 2)
     trans_map = np.reshape(trans_map, (height, width))
-    Airlight = get_airlight(hazy_image, trans_map, p)
+    Airlight = get_airlight(hazy_image, trans_map, p, A_stride)
     clear_image = get_radiance(hazy_image, Airlight, trans_map, L)
     
     return clear_image
 
+def usemodel_batch(mscnn, images, max_batch = 8, multiple = 2, A_stride = 1):
+    '''
+    usemodel on a list of images, run as real batches of at most max_batch
+    images of the same shape. The network needs even sizes, so images are
+    edge padded to a multiple of multiple (at least 2) rather than resized,
+    and keep their size. A_stride is that of usemodel. Returns the dehazed
+    images in input order.
+    '''
+    p = 0.001
+    L = 256
+    
+    multiple = multiple * 2 if multiple % 2 else multiple
+    trans_maps = predict_images(mscnn, images, max_batch, multiple)
+    clear_images = []
+    for hazy_image, trans_map in zip(images, trans_maps):
+        trans_map = trans_map[:, :, 0]
+        Airlight = get_airlight(hazy_image, trans_map, p, A_stride)
+        clear_images.append(get_radiance(hazy_image, Airlight, trans_map, L))
+    
+    return clear_images
+
 if __name__ =="__main__":
     '''
     Implementation of MSCNN using keras. https://link.springer.com/chapter/10.1007/978-3-319-46475-6_10
     
     Usage:
         1. modify the paths
-        2. potentially change a line in load_data (see above)
+        2. potentially change the naming rule pair_files gets in train_model,
+           which pairs hazy images with their labels (see pairing.RULES)
         3. run this file
         4. visualize the images using:
             cv2.imshow('nameofwindow', hazy_image)
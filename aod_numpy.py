@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+AOD-Net inference in plain NumPy.
+
+Loads the aodnet.h5 weights written by AOD_Net.train_model and runs the
+forward pass of AOD_Net.aodmodel without importing Keras, so worker
+processes start in milliseconds. The model has the predict method of a
+Keras model, so batching.predict_images and batching.predict_tiled accept
+it as well.
+'''
+import h5py
+import numpy as np
+
+# convolutions of AOD_Net.aodmodel in order
+LAYERS = ('conv1', 'conv2', 'conv3', 'conv4', 'conv5')
+
+def load_weights(weights):
+    '''
+    {layer name: (kernel, bias)} of the convolutions in a Keras weights file,
+    kernel of shape (height, width, input channels, output channels).
+    '''
+    params = {}
+    with h5py.File(weights, 'r') as f:
+        if 'model_weights' in f:    # saved with model.save rather than save_weights
+            f = f['model_weights']
+        for name in LAYERS:
+            group = f[name]
+            names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+            kernel, bias = (np.asarray(group[n], np.float32) for n in names)
+            params[name] = (kernel, bias)
+    return params
+
+def conv2d_relu(x, kernel, bias):
+    '''
+    relu of the zero padded ('same') convolution of an N * H * W * C batch.
+
+    The kernel is applied as one small matrix product per tap, each on a
+    shifted view of the padded input, so memory stays at one output map
+    instead of the kh * kw copies of im2col.
+    '''
+    kh, kw = kernel.shape[:2]
+    n, height, width = x.shape[:3]
+    if kh > 1 or kw > 1:
+        x = np.pad(x, ((0, 0), (kh // 2, kh // 2), (kw // 2, kw // 2), (0, 0)))
+
+    out = np.empty((n, height, width, kernel.shape[3]), np.float32)
+    out[...] = bias
+    for dy in range(kh):
+        for dx in range(kw):
+            out += x[:, dy:dy + height, dx:dx + width] @ kernel[dy, dx]
+
+    return np.maximum(out, 0, out = out)
+
+class AODNet(object):
+    '''
+    weights  path of the aodnet.h5 weights file
+    '''
+
+    def __init__(self, weights):
+
+        self.params = load_weights(weights)
+
+    def predict(self, hazy_input, batch_size = None):
+        '''
+        Dehazed N * H * W * 3 batch of the hazy_input batch scaled to [0, 1],
+        as AOD_Net.aodmodel().predict.
+        '''
+        x = np.asarray(hazy_input, np.float32)
+        conv = lambda name, inputs: conv2d_relu(inputs, *self.params[name])
+
+        conv1 = conv('conv1', x)
+        conv2 = conv('conv2', conv1)
+        conv3 = conv('conv3', np.concatenate([conv1, conv2], axis = -1))
+        conv4 = conv('conv4', np.concatenate([conv2, conv3], axis = -1))
+        k = conv('conv5', np.concatenate([conv1, conv2, conv3, conv4], axis = -1))
+
+        # relu(K(x) * I - K(x) + 1)
+        out = np.multiply(k, x, out = conv1)
+        out -= k
+        out += 1
+
+        return np.maximum(out, 0, out = out)
+
+def Load_model(weights):
+    return AODNet(weights)
+
+def usemodel(model, hazy_image):
+    '''
+    AOD_Net.usemodel with the NumPy model.
+    '''
+    hazy_input = hazy_image[np.newaxis] / 255.0
+    clear_ = model.predict(hazy_input)
+    clear_image = np.floor(clear_[0] * 255.0).astype(np.uint8)
+
+    return clear_image
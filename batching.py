@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+Batched inference of fully convolutional networks on images of mixed sizes.
+'''
+import numpy as np
+
+def padded_shape(shape, multiple):
+    '''
+    (height, width) of shape rounded up to a multiple of multiple.
+    '''
+    return tuple(-(-n // multiple) * multiple for n in shape[:2])
+
+def predict_images(model, images, max_batch = 8, multiple = 1):
+    '''
+    model.predict on a list of uint8 H * W * C images of mixed sizes.
+
+    Images are scaled by 1 / 255.0, edge padded up to a multiple of multiple
+    if needed and grouped into buckets of equal padded shape. Each bucket is
+    run in batches of at most max_batch images. The outputs are cropped back
+    to the size of their image and returned in input order; the model must
+    keep the spatial size of its input.
+    '''
+    buckets = {}
+    for i, image in enumerate(images):
+        buckets.setdefault(padded_shape(image.shape, multiple), []).append(i)
+
+    outputs = [None] * len(images)
+    for (height, width), indices in buckets.items():
+        for start in range(0, len(indices), max_batch):
+            batch = indices[start:start + max_batch]
+            hazy_input = np.stack([np.pad(images[i], ((0, height - images[i].shape[0]),
+                                                      (0, width - images[i].shape[1]), (0, 0)), 'edge')
+                                   for i in batch]) / 255.0
+            predictions = model.predict(hazy_input, batch_size = len(batch))
+            for i, prediction in zip(batch, predictions):
+                outputs[i] = prediction[:images[i].shape[0], :images[i].shape[1]]
+
+    return outputs
+
+def ramp(size, before, after, blend):
+    '''
+    Weights of the size rows (or columns) of one tile: rising linearly over
+    the first 2 * blend if another tile comes before, falling over the last
+    2 * blend if one comes after. Overlapping ramps of neighbours sum to 1.
+    '''
+    weights = np.ones(size, np.float32)
+    if blend > 0:
+        steps = (np.arange(2 * blend, dtype = np.float32) + 0.5) / (2 * blend)
+        if before:
+            weights[:2 * blend] = steps
+        if after:
+            weights[size - 2 * blend:] = steps[::-1]
+    return weights
+
+def tile_bounds(size, tile, blend):
+    '''
+    (start, stop) of the tiles along an axis of length size. A last tile
+    shorter than 2 * blend is merged into the one before it, so that every
+    seam has room for its cross-fade.
+    '''
+    starts = list(range(0, size, tile))
+    if len(starts) > 1 and size - starts[-1] < 2 * blend:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [size]))
+
+def predict_tiled(model, image, tile = 512, halo = 0, blend = 8, multiple = 1):
+    '''
+    model.predict on one uint8 H * W * C image, tile * tile pixels at a time.
+
+    Each tile is run with halo extra pixels of context on every side, so with
+    halo at least the receptive field radius of the network its output equals
+    that of full-frame inference. Neighbouring tiles overlap by a further
+    2 * blend pixels across their seam, where the outputs are cross-faded
+    linearly. Peak memory of the network is that of a
+    (tile + 2 * (halo + blend))^2 input instead of the whole image. tile,
+    halo and blend are rounded up to multiples of multiple, the size the
+    network needs (2 for one 2 * 2 pooling level), and the image is edge
+    padded to a multiple of it as in predict_images.
+    '''
+    tile = -(-tile // multiple) * multiple
+    blend = min(blend, tile // 2)
+    margin = -(-(halo + blend) // multiple) * multiple
+    
+    height, width = image.shape[:2]
+    padded_height, padded_width = padded_shape(image.shape, multiple)
+    image = np.pad(image, ((0, padded_height - height), (0, padded_width - width), (0, 0)), 'edge')
+    
+    out = None
+    rows = tile_bounds(padded_height, tile, blend)
+    cols = tile_bounds(padded_width, tile, blend)
+    for y0, y1 in rows:
+        for x0, x1 in cols:
+            # cross-faded region, and the input region around it
+            wy0, wy1 = max(y0 - blend, 0), min(y1 + blend, padded_height)
+            wx0, wx1 = max(x0 - blend, 0), min(x1 + blend, padded_width)
+            iy0, iy1 = max(y0 - margin, 0), min(y1 + margin, padded_height)
+            ix0, ix1 = max(x0 - margin, 0), min(x1 + margin, padded_width)
+            
+            prediction = model.predict(image[np.newaxis, iy0:iy1, ix0:ix1] / 255.0)[0]
+            if out is None:
+                out = np.zeros((padded_height, padded_width, prediction.shape[-1]), np.float32)
+            
+            weights = (ramp(wy1 - wy0, y0 > 0, y1 < padded_height, blend)[:, np.newaxis] *
+                       ramp(wx1 - wx0, x0 > 0, x1 < padded_width, blend)[np.newaxis, :])
+            out[wy0:wy1, wx0:wx1] += weights[:, :, np.newaxis] * prediction[wy0 - iy0:wy1 - iy0, wx0 - ix0:wx1 - ix0]
+    
+    return out[:height, :width]
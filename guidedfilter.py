@@ -9,47 +9,152 @@ http://research.microsoft.com/en-us/um/people/kahe/eccv10/
 
 from itertools import combinations_with_replacement
 from collections import defaultdict
+from functools import lru_cache
 
+import cv2
 import numpy as np
-from numpy.linalg import inv
 
 R, G, B = 0, 1, 2  # index for convenience
 
-def boxfilter(I, r):  #就是以r为半径把周围一圈的数字都加起来
+def boxfilter(I, r, out=None, scratch=None):  #就是以r为半径把周围一圈的数字都加起来
     """Fast box filter implementation.
 
     Parameters
     ----------
-    I:  a single channel/gray image data normalized to [0.0, 1.0]
-    r:  window radius
+    I:   a single channel/gray image data normalized to [0.0, 1.0], or an
+         M * N * K stack of such images, all filtered in a single pass
+    r:   window radius
+    out: optional array for the result, may be I itself to filter in place
+    scratch: optional buffer for the running sums, with the shape and dtype
+         of the result but only scratch_rows(M, r) rows
 
     Return
     -----------
-    The filtered image data.
+    The filtered image data, float32 for float32 input and float64 otherwise.
     """
-    M, N = I.shape
-    dest = np.zeros((M, N))
-
-    # cumulative sum over Y axis
-    sumY = np.cumsum(I, axis=0)
-    # difference over Y axis
-    dest[:r + 1] = sumY[r: 2 * r + 1]
-    dest[r + 1:M - r] = sumY[2 * r + 1:] - sumY[:M - 2 * r - 1]
-    dest[-r:] = np.tile(sumY[-1], (r, 1)) - sumY[M - 2 * r - 1:M - r - 1]
-
-    # cumulative sum over X axis
-    sumX = np.cumsum(dest, axis=1)
-    # difference over Y axis
-    dest[:, :r + 1] = sumX[:, r:2 * r + 1]
-    dest[:, r + 1:N - r] = sumX[:, 2 * r + 1:] - sumX[:, :N - 2 * r - 1]
-    dest[:, -r:] = np.tile(sumX[:, -1][:, None], (1, r)) - \
-        sumX[:, N - 2 * r - 1:N - r - 1]
+    M, N = I.shape[:2]
+    R = scratch_rows(M, r)
+    # keep the memory layout of I, so planes of a stack stay contiguous
+    if scratch is None:
+        scratch = np.empty_like(I[:R], dtype=I.dtype if I.dtype == np.float32 else np.float64)
+    dest = np.empty_like(scratch, shape=(M,) + scratch.shape[1:]) if out is None else out
+
+    # cumulative sums over Y axis, one row at a time (np.cumsum walks axis 0
+    # column by column, which is several times slower on large images), in
+    # a ring of the 2r + 2 rows a box still needs. Row y of I is read before
+    # dest[y] is written, so dest may overwrite I.
+    def sumY(y):
+        return scratch[y % R]
+
+    sumY(0)[...] = I[0]
+    for y in range(1, min(r + 1, M)):
+        np.add(sumY(y - 1), I[y], out=sumY(y))
+    for y in range(M):
+        if 0 < y < M - r:
+            np.add(sumY(y + r - 1), I[y + r], out=sumY(y + r))
+        # difference over Y axis
+        if y <= r:
+            dest[y] = sumY(min(y + r, M - 1))
+        else:
+            np.subtract(sumY(min(y + r, M - 1)), sumY(y - r - 1), out=dest[y])
+
+    # cumulative sum over X axis, R rows at a time
+    for y in range(0, M, R):
+        rows = dest[y:y + R]
+        sumX = np.cumsum(rows, axis=1, out=scratch[:len(rows)])
+        # difference over X axis
+        rows[:, :r + 1] = sumX[:, r:2 * r + 1]
+        np.subtract(sumX[:, 2 * r + 1:], sumX[:, :N - 2 * r - 1],
+                    out=rows[:, r + 1:N - r])
+        np.subtract(sumX[:, -1:], sumX[:, N - 2 * r - 1:N - r - 1],
+                    out=rows[:, -r:])
 
     return dest
 
 
-def guided_filter(I, p, r=40, eps=1e-3):
-    """Refine a filter under the guidance of another (RGB) image.
+def scratch_rows(M, r):
+    """Rows of the boxfilter scratch buffer for M-row images: the 2r + 2 rows
+    of running sums a box of radius r needs at once."""
+    return min(M, 2 * r + 2)
+
+
+@lru_cache(maxsize=16)
+def box_base(M, N, r):
+    """Number of pixels in each box of radius r over an M * N image.
+
+    Cached per (M, N, r), so frames of a fixed size share one read-only map.
+    """
+    base = boxfilter(np.ones((M, N)), r)
+    base.flags.writeable = False
+
+    return base
+
+
+def workspace(M, N, dtype=np.float64, s=1, r=40):
+    """Buffers for guided_filter on M * N images, to reuse across frames.
+
+    Return
+    -----------
+    A (stack, scratch) pair of arrays stored plane by plane, sized for the
+    subsampled image when s > 1: the M * N * 13 stack of filtered maps and
+    a scratch_rows(M, r) * N * 13 buffer for the running sums of the box
+    filter and the cofactors of solve_sym3.
+    """
+    if s > 1:
+        M, N, r = max(M // s, 1), max(N // s, 1), max(r // s, 1)
+
+    return (np.empty((13, M, N), dtype).transpose(1, 2, 0),
+            np.empty((13, scratch_rows(M, r), N), dtype).transpose(1, 2, 0))
+
+
+def solve_sym3(rr, rg, rb, gg, gb, bb, cov, out=None, tmp=None):
+    """Solve cov * Sigma^-1 for every pixel at once.
+
+    Parameters
+    ----------
+    rr, rg, rb, gg, gb, bb: the M * N entries of the symmetric matrix
+
+                 rr, rg, rb
+         Sigma = rg, gg, gb
+                 rb, gb, bb
+
+    cov: a list of the 3 M * N covariance maps
+    out: optional M * N * 3 array for the result. It may share memory with
+         the entries of Sigma, which are not read once the cofactors exist.
+    tmp: optional M * N * 7 buffer for the cofactors and the determinant
+
+    Return
+    -----------
+    An M * N * 3 array, the row vector cov * Sigma^-1 at each pixel.
+    """
+    if tmp is None:
+        tmp = np.empty((7,) + rr.shape, rr.dtype).transpose(1, 2, 0)
+    c_rr, c_rg, c_rb, c_gg, c_gb, c_bb, det = [tmp[:, :, k] for k in range(7)]
+
+    # cofactors of Sigma; Sigma^-1 = adj(Sigma) / det(Sigma) is symmetric too
+    for c, (x1, y1, x2, y2) in zip(
+            (c_rr, c_rg, c_rb, c_gg, c_gb, c_bb),
+            ((gg, bb, gb, gb), (gb, rb, rg, bb), (rg, gb, gg, rb),
+             (rr, bb, rb, rb), (rg, rb, rr, gb), (rr, gg, rg, rg))):
+        np.multiply(x1, y1, out=c)
+        c -= x2 * y2
+    np.multiply(rr, c_rr, out=det)
+    det += rg * c_rg
+    det += rb * c_rb
+
+    a = np.empty(rr.shape + (3,), rr.dtype) if out is None else out
+    for i, (c1, c2, c3) in ((R, (c_rr, c_rg, c_rb)), (G, (c_rg, c_gg, c_gb)),
+                            (B, (c_rb, c_gb, c_bb))):
+        np.multiply(cov[R], c1, out=a[:, :, i])
+        a[:, :, i] += cov[G] * c2
+        a[:, :, i] += cov[B] * c3
+    a /= det[:, :, None]
+
+    return a
+
+
+def mean_coefficients(I, p, r, eps, work=None):
+    """Local linear coefficients of the guided filter, averaged over windows.
 
     Parameters
     -----------
@@ -57,46 +162,107 @@ def guided_filter(I, p, r=40, eps=1e-3):
     p:   the M * N filter to be guided
     r:   the radius of the guidance
     eps: epsilon for the guided filter
+    work: optional buffers from workspace(M, N, dtype, 1, r), overwritten
 
     Return
     -----------
-    The guided filter.
+    mean_a, an M * N * 3 array, and mean_b, an M * N array, such that the
+    guided filter is q = sum(mean_a * I) + mean_b (ECCV10 eq.16). They are
+    float32 when both I and p are float32.
     """
     M, N = p.shape
-    base = boxfilter(np.ones((M, N)), r)
+    dtype = np.result_type(I.dtype, p.dtype, np.float32)
+    base = box_base(M, N, r)[:, :, None]
+    pairs = list(combinations_with_replacement(range(3), 2))
+
+    # filter I, I * p, p and I_i * I_j with the mean filter in one stack;
+    # division by base is mean!!! The stack is M * N * K but stored plane
+    # by plane, so each filtered map below is a contiguous view. All later
+    # steps reuse its planes instead of allocating new maps.
+    if work is None:
+        work = workspace(M, N, dtype, 1, r)
+    stack, scratch = work
+    stack[:, :, 0:3] = I
+    np.multiply(I, p[:, :, None], out=stack[:, :, 3:6])
+    stack[:, :, 6] = p
+    for k, (i, j) in enumerate(pairs):
+        np.multiply(I[:, :, i], I[:, :, j], out=stack[:, :, 7 + k])
+    boxfilter(stack, r, out=stack, scratch=scratch)
+    stack /= base
 
-    # each channel of I filtered with the mean filter; division by base is mean!!!
-    means = [boxfilter(I[:, :, i], r) / base for i in range(3)]
-    # p filtered with the mean filter
-    mean_p = boxfilter(p, r) / base
-    # filter I with p then filter it with the mean filter
-    means_IP = [boxfilter(I[:, :, i] * p, r) / base for i in range(3)]
+    means = [stack[:, :, i] for i in range(3)]
+    mean_p = stack[:, :, 6]
     # covariance of (I, p) in each local patch
-    covIP = [means_IP[i] - means[i] * mean_p for i in range(3)]
+    covIP = [stack[:, :, 3 + i] for i in range(3)]
+    for i in range(3):
+        covIP[i] -= means[i] * mean_p
 
     # variance of I in each local patch: the matrix Sigma in ECCV10 eq.14
     var = defaultdict(dict)
-    for i, j in combinations_with_replacement(range(3), 2):
-        var[i][j] = boxfilter(
-            I[:, :, i] * I[:, :, j], r) / base - means[i] * means[j]
-
-    a = np.zeros((M, N, 3))
-    for y, x in np.ndindex(M, N):
-        #         rr, rg, rb
-        # Sigma = rg, gg, gb
-        #         rb, gb, bb
-        Sigma = np.array([[var[R][R][y, x], var[R][G][y, x], var[R][B][y, x]],
-                          [var[R][G][y, x], var[G][G][y, x], var[G][B][y, x]],
-                          [var[R][B][y, x], var[G][B][y, x], var[B][B][y, x]]])
-        cov = np.array([c[y, x] for c in covIP])
-        a[y, x] = np.dot(cov, inv(Sigma + eps * np.eye(3)))  # eq 14
+    for k, (i, j) in enumerate(pairs):
+        var[i][j] = stack[:, :, 7 + k]
+        var[i][j] -= means[i] * means[j]
+        if i == j:
+            var[i][j] += eps
+
+    # a goes to the rr, rg, rb planes and b to the gg plane, next to each
+    # other; solved a block of rows at a time, for the cofactors to fit in
+    # the scratch buffer
+    ab = stack[:, :, 7:11]
+    a = ab[:, :, 0:3]
+    sigma = [var[R][R], var[R][G], var[R][B], var[G][G], var[G][B], var[B][B]]
+    rows = len(scratch)
+    for y in range(0, M, rows):
+        block = slice(y, y + rows)
+        solve_sym3(*[v[block] for v in sigma], [c[block] for c in covIP],
+                   out=a[block], tmp=scratch[:len(a[block]), :, 0:7])  # eq 14
 
     # ECCV10 eq.15
-    b = mean_p - a[:, :, R] * means[R] - \
-        a[:, :, G] * means[G] - a[:, :, B] * means[B]
+    b = ab[:, :, 3]
+    b[...] = mean_p
+    for i in range(3):
+        b -= a[:, :, i] * means[i]
+
+    boxfilter(ab, r, out=ab, scratch=scratch[:, :, 7:11])
+    ab /= base
+
+    return ab[:, :, 0:3], ab[:, :, 3]
+
+
+def guided_filter(I, p, r=40, eps=1e-3, s=1, work=None):
+    """Refine a filter under the guidance of another (RGB) image.
+
+    Parameters
+    -----------
+    I:   an M * N * 3 RGB image for guidance.
+    p:   the M * N filter to be guided
+    r:   the radius of the guidance
+    eps: epsilon for the guided filter
+    s:   subsampling ratio. With s > 1 the coefficients are computed on I and
+         p shrunk by s and upsampled again (fast guided filter, He & Sun
+         2015), about s^2 times faster at a small loss in accuracy.
+    work: optional buffers from workspace(M, N, dtype, s, r), reused between
+         calls on same-size images
+
+    Return
+    -----------
+    The guided filter.
+    """
+    if s <= 1:
+        mean_a, mean_b = mean_coefficients(I, p, r, eps, work)
+    else:
+        M, N = p.shape
+        size = (max(N // s, 1), max(M // s, 1))
+        I_sub = cv2.resize(I, size, interpolation=cv2.INTER_NEAREST)
+        p_sub = cv2.resize(p, size, interpolation=cv2.INTER_NEAREST)
+        mean_a, mean_b = mean_coefficients(I_sub, p_sub, max(r // s, 1), eps, work)
+        mean_a = cv2.resize(mean_a, (N, M), interpolation=cv2.INTER_LINEAR)
+        mean_b = cv2.resize(mean_b, (N, M), interpolation=cv2.INTER_LINEAR)
 
     # ECCV10 eq.16
-    q = (boxfilter(a[:, :, R], r) * I[:, :, R] + boxfilter(a[:, :, G], r) *
-         I[:, :, G] + boxfilter(a[:, :, B], r) * I[:, :, B] + boxfilter(b, r)) / base
+    q = mean_a[:, :, R] * I[:, :, R]
+    for i in (G, B):
+        q += mean_a[:, :, i] * I[:, :, i]
+    q += mean_b
 
     return q
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+Memoized loading of the dehazing networks.
+
+Models are built and their weights loaded on first use only, then kept in a
+least recently used cache keyed by (architecture, weights path, weights file
+modification time), so retrained weights are picked up automatically. The
+network modules, and with them Keras, are imported lazily as well.
+'''
+import os
+import importlib
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+# architecture name: module whose Load_model builds it and loads weights
+ARCHITECTURES = {'AOD': 'AOD_Net',
+                 'AOD-NumPy': 'aod_numpy',
+                 'DehazeNet': 'DehazeNet',
+                 'MSCNN': 'MSCNN',
+                 'int8': 'quantization'}
+
+class ModelRegistry(object):
+    '''
+    LRU cache of loaded models.
+
+    max_models  number of models kept; the least recently used one is dropped
+                when a new one is loaded
+    '''
+
+    def __init__(self, max_models = 3):
+
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, architecture, weights, warmup_shapes = ()):
+        '''
+        The model of the given architecture with weights loaded, building it
+        on first use. warmup_shapes is a list of (height, width) or (batch,
+        height, width) input shapes run once through a newly loaded model, so
+        graph construction is not paid by the first real predict.
+        '''
+        key = (architecture, os.path.abspath(weights), os.path.getmtime(weights))
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            module = importlib.import_module(ARCHITECTURES[architecture])
+            model = module.Load_model(weights)
+            warmup(model, warmup_shapes)
+
+            self.models[key] = model
+            self.evict()
+
+            return model
+
+    def set_max_models(self, max_models):
+
+        with self.lock:
+            self.max_models = max_models
+            self.evict()
+
+    def evict(self):
+
+        while len(self.models) > self.max_models:
+            self.models.popitem(last = False)
+
+    def clear(self):
+
+        with self.lock:
+            self.models.clear()
+
+def warmup(model, shapes):
+    '''
+    Run model once on zero images of each of the given input shapes.
+    '''
+    for shape in shapes:
+        if len(shape) == 2:
+            shape = (1,) + tuple(shape)
+        model.predict(np.zeros(tuple(shape) + (3,)))
+
+_registry = ModelRegistry()
+
+def get_model(architecture, weights, warmup_shapes = ()):
+    '''
+    ModelRegistry.get on the registry shared by the whole process.
+    '''
+    return _registry.get(architecture, weights, warmup_shapes)
+
+def set_max_models(max_models):
+
+    _registry.set_max_models(max_models)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''
+Pairing of hazy images with their labels (clear images or transmission
+maps) by file name.
+
+A naming rule turns a hazy file name into the scene ID that names its
+label. The label folder is indexed once into a dict keyed by file name
+without extension, so pairing is one lookup per hazy image, and the pairs
+of each (hazy folder, label folder, rule) are cached to disk until either
+folder changes.
+'''
+import os
+import re
+import json
+import hashlib
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dehaze')
+
+def scene_id(data_file):
+    '''
+    '1400_1_0.8.png' -> '1400': the clear image of RESIDE ITS, OTS and SOTS
+    hazy images
+    '''
+    return os.path.splitext(data_file)[0].split('_')[0]
+
+def scene_haze_id(data_file):
+    '''
+    '1400_1_0.8.png' -> '1400_1': the transmission map of a RESIDE ITS hazy
+    image
+    '''
+    return '_'.join(os.path.splitext(data_file)[0].split('_')[:2])
+
+def same_name(data_file):
+    '''
+    '1400.png' -> '1400': a label named like its image, e.g. the depth map of
+    a clear image
+    '''
+    return os.path.splitext(data_file)[0]
+
+def regex_rule(pattern):
+    '''
+    Naming rule for hazy files whose label is named by the first group of the
+    regular expression pattern, e.g. regex_rule('^([0-9]+)_') for
+    '1400_1.png' -> '1400'.
+    '''
+    pattern = re.compile(pattern)
+
+    def rule(data_file):
+        match = pattern.search(data_file)
+        return match.group(1) if match else None
+
+    rule.pattern = pattern.pattern
+    return rule
+
+def rule_identity(rule):
+    '''
+    Text naming the rule function across runs, for the pairs cache: its
+    module and qualified name, and its pattern if made by regex_rule. None
+    for lambdas and other nested functions, which have no such name.
+    '''
+    name = getattr(rule, '__qualname__', '<unnamed>')
+    pattern = getattr(rule, 'pattern', None)
+    if pattern is None and '<' in name:
+        return None
+
+    return '%s.%s %s' % (rule.__module__, name, '' if pattern is None else pattern)
+
+# rule name: function from a hazy file name to the name without extension of
+# its label
+RULES = {'ITS': scene_id,
+         'ITS-trans': scene_haze_id,
+         'OTS': scene_id,
+         'SOTS': scene_id,
+         'same': same_name}
+
+def register_rule(name, rule):
+
+    RULES[name] = rule
+
+def pair_files(data_path, label_path, rule, cache_dir = CACHE_DIR):
+    '''
+    {hazy file: label file} of the images in data_path, in listing order,
+    paired by the naming rule of the given name. Raises ValueError for a
+    hazy image without a label.
+
+    The pairs are cached in cache_dir, or not at all if it is None or the
+    rule has no rule_identity, and reused as long as neither folder has been
+    modified and the rule is the same function.
+    '''
+    stamp = [os.path.getmtime(data_path), os.path.getmtime(label_path)]
+    identity = rule_identity(RULES[rule])
+    if identity is None:
+        cache_dir = None
+    if cache_dir is not None:
+        key = '\0'.join([os.path.abspath(data_path), os.path.abspath(label_path), identity])
+        cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode('utf8')).hexdigest() + '.json')
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['stamp'] == stamp:
+                return cached['pairs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    labels = {os.path.splitext(label_file)[0]: label_file for label_file in os.listdir(label_path)}
+    pairs = {}
+    for data_file in os.listdir(data_path):
+        label = labels.get(RULES[rule](data_file))
+        if label is None:
+            raise ValueError('no label in %s for %s' % (label_path, data_file))
+        pairs[data_file] = label
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        with open(cache_path, 'w') as f:
+            json.dump({'stamp': stamp, 'pairs': pairs}, f)
+
+    return pairs
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''
+Multi-core execution for DCP and the guided filter.
+
+Threads split one image into row strips; NumPy releases the GIL inside its
+loops, so the strips are filtered in parallel. Processes dehaze batches of
+images, one image per task, reading and writing the frames through shared
+memory so they are never pickled.
+'''
+import os
+import time
+import numpy as np
+import guidedfilter
+import DCP
+
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def guided_filter(I, p, r = 40, eps = 1e-3, s = 1, workers = None):
+    '''
+    guidedfilter.guided_filter on row strips run by a pool of threads.
+
+    Each strip is grown by 2r rows (plus 2s if s > 1), the reach of the two
+    box filters, so with s = 1 the result matches the single-threaded filter.
+    Strips are at least 4 halos high (DCP.strip_rows), so the redundant rows
+    stay under half the work and small images use fewer threads than
+    workers, which defaults to the number of CPUs.
+    '''
+    M, N = p.shape
+    halo = 2 * r + (2 * s if s > 1 else 0)
+    rows = DCP.strip_rows(M, workers or os.cpu_count(), halo)
+    if rows == M:
+        return guidedfilter.guided_filter(I, p, r, eps, s)
+    q = np.empty((M, N), np.result_type(I.dtype, p.dtype, np.float32))
+
+    def strip(blocks):
+        core, grown, inner = blocks
+        q[core] = guidedfilter.guided_filter(I[grown], p[grown], r, eps, s)[inner]
+
+    with ThreadPoolExecutor(-(-M // rows)) as pool:
+        for _ in pool.map(strip, DCP.tiles(M, N, (rows, N), halo)):
+            pass
+
+    return q
+
+def dehaze(im, workers = None, **params):
+    '''
+    Dehaze one image with DCP on row strips run by a pool of threads, as
+    many as DCP.strip_rows allows. params are those of DCP.DCPDehazer: the
+    defaults give DCP.dehaze_1, tmin = 0.2 and Amax = 220 give DCP.dehaze_2.
+    '''
+    params['workers'] = workers or os.cpu_count()
+    params.setdefault('sizes', 0)
+
+    return DCP.DCPDehazer(**params).dehaze(im)
+
+# state of a worker process of dehaze_batch, set up once by _attach
+_worker = {}
+
+def _attach(src_name, dst_name, params):
+
+    _worker['src'] = shared_memory.SharedMemory(name = src_name)
+    _worker['dst'] = shared_memory.SharedMemory(name = dst_name)
+    _worker['dehazer'] = DCP.DCPDehazer(**params)
+
+def _dehaze_shared(task):
+
+    offset, shape = task
+    src = np.ndarray(shape, np.uint8, buffer = _worker['src'].buf, offset = offset)
+    dst = np.ndarray(shape, np.uint8, buffer = _worker['dst'].buf, offset = offset)
+    dst[...] = _worker['dehazer'].dehaze(src)
+
+def dehaze_batch(images, workers = None, **params):
+    '''
+    Dehaze a list of uint8 images with DCP on a pool of processes.
+
+    The images are copied once into a shared memory block and each worker
+    writes its results into a second one, so only offsets and shapes cross
+    the process boundary. Every worker keeps one DCP.DCPDehazer, whose
+    buffers are reused between same-size images. params are those of
+    DCP.DCPDehazer; workers defaults to the number of CPUs. Returns the
+    dehazed images in input order.
+    '''
+    shapes = [np.shape(im) for im in images]
+    offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+    size = max(int(offsets[-1]), 1)
+
+    src = shared_memory.SharedMemory(create = True, size = size)
+    dst = shared_memory.SharedMemory(create = True, size = size)
+    try:
+        for im, offset, shape in zip(images, offsets, shapes):
+            np.ndarray(shape, np.uint8, buffer = src.buf, offset = offset)[...] = im
+
+        with ProcessPoolExecutor(workers or os.cpu_count(), initializer = _attach,
+                                 initargs = (src.name, dst.name, params)) as pool:
+            for _ in pool.map(_dehaze_shared, zip(offsets.tolist(), shapes)):
+                pass
+
+        return [np.ndarray(shape, np.uint8, buffer = dst.buf, offset = offset).copy()
+                for offset, shape in zip(offsets, shapes)]
+    finally:
+        src.close()
+        src.unlink()
+        dst.close()
+        dst.unlink()
+
+def scaling(images, worker_counts = (1, 2, 4, 8, 16, 32), **params):
+    '''
+    Compare wall-clock time per image of the threaded and the multi-process
+    DCP for each number of workers. Returns {workers: (threads, processes)}.
+    '''
+    times = {}
+    for workers in worker_counts:
+        start = time.perf_counter()
+        for im in images:
+            _ = dehaze(im, workers, **params)
+        threads = (time.perf_counter() - start) / len(images)
+
+        start = time.perf_counter()
+        _ = dehaze_batch(images, workers, **params)
+        processes = (time.perf_counter() - start) / len(images)
+
+        times[workers] = (threads, processes)
+        print('%2d workers: threads %.3f s, processes %.3f s per image' % (workers, threads, processes))
+
+    return times
+
+if __name__ =="__main__":
+
+    images_path = ''    # folder of hazy images
+    import cv2
+    images = [cv2.imread(images_path + '/' + f) for f in os.listdir(images_path)]
+    scaling(images, tmin = 0.2, Amax = 220)
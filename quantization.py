@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+'''
+Post-training int8 quantization of AOD-Net, DehazeNet and MSCNN.
+
+A trained network is converted to a TensorFlow Lite model whose weights are
+int8 with one scale per output channel and whose activations are int8 with
+scales calibrated on a sample of hazy images. Inference then runs on the
+integer kernels of the TensorFlow Lite interpreter. QuantizedModel has the
+predict method of a Keras model, so the usemodel function of each network
+module runs it unchanged.
+
+The converted graph is fixed to one 1 * H * W * 3 input: upsampling sizes,
+reshapes and the like become constants. Other inputs are run one image at a
+time, and images of another size window by window at the conversion shape.
+'''
+import cv2
+import json
+import importlib
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+from keras.layers import Input
+from model_registry import ARCHITECTURES
+
+# (height, width) the networks are calibrated and converted at by default:
+# the patch size of DehazeNet, the training size of the others. Other sizes
+# are tiled at predict time.
+CALIBRATION_SHAPES = {'AOD': (240, 320),
+                      'DehazeNet': (16, 16),
+                      'MSCNN': (240, 320)}
+
+# multiple the windows of a network must start at, 2 for one 2 * 2 pooling
+# level; 1 if not listed
+TILE_MULTIPLES = {'MSCNN': 2}
+
+# conversion shapes only ever run on inputs of exactly that shape, the
+# patches of DehazeNet, which therefore need not leave room for tiling
+PATCH_SHAPES = {'DehazeNet': (16, 16)}
+
+def tile_step(window, shrink, halo, multiple):
+    '''
+    Output pixels each window of the given input size contributes along an
+    axis when tiled (see QuantizedModel.spans): its output, shrink pixels
+    smaller, less halo at both ends and the slack of starting at a multiple
+    of multiple. Raises ValueError if none are left.
+    '''
+    step = window - shrink - 2 * halo - (multiple - 1)
+    if step < 1:
+        raise ValueError('a %d pixel window leaves no output with a halo of %d' % (window, halo))
+
+    return step
+
+def calibration_data(images, shape, samples = 100, seed = 0):
+    '''
+    Generator of samples random shape crops of the uint8 images, each scaled
+    to [0, 1] and wrapped as the one-element input list TFLiteConverter
+    expects. Images smaller than shape are resized instead.
+    '''
+    random = np.random.RandomState(seed)
+    height, width = shape
+    for i in range(samples):
+        image = images[i % len(images)]
+        if image.shape[0] < height or image.shape[1] < width:
+            image = cv2.resize(image, (width, height), interpolation = cv2.INTER_AREA)
+        y = random.randint(image.shape[0] - height + 1)
+        x = random.randint(image.shape[1] - width + 1)
+        crop = image[y:y + height, x:x + width]
+        yield [(crop[np.newaxis] / 255.0).astype(np.float32)]
+
+def quantize(architecture, weights, images, quantized_path, samples = 100, shape = None):
+    '''
+    Calibrate the network of the given architecture with weights loaded on
+    samples crops of images, a list of uint8 hazy images, and write the int8
+    model to quantized_path, and its tiling to quantized_path + '.json'.
+    Returns quantized_path.
+
+    The graph is converted at shape, CALIBRATION_SHAPES[architecture] if
+    None, e.g. a larger one for the dense mode of DehazeNet. Unless it is in
+    PATCH_SHAPES, raises ValueError if the shape is too small to tile with
+    the RECEPTIVE_RADIUS of the network (see tile_step). Conversion fails if
+    the graph uses an operation without an int8 kernel, rather than silently
+    falling back to float.
+    '''
+    module = importlib.import_module(ARCHITECTURES[architecture])
+    model = module.Load_model(weights)
+
+    # the converter needs static dimensions
+    shape = shape or CALIBRATION_SHAPES[architecture]
+    fixed_input = Input(batch_shape = (1,) + shape + (3,))
+    fixed_output = model(fixed_input)
+    halo = getattr(module, 'RECEPTIVE_RADIUS', 0)
+    multiple = TILE_MULTIPLES.get(architecture, 1)
+    if shape != PATCH_SHAPES.get(architecture):
+        for window, outputs in zip(shape, K.int_shape(fixed_output)[1:3]):
+            tile_step(window, window - outputs, halo, multiple)
+
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), [fixed_input], [fixed_output])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: calibration_data(images, shape, samples)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(quantized_path, 'wb') as f:
+        f.write(converter.convert())
+    with open(quantized_path + '.json', 'w') as f:
+        json.dump({'architecture': architecture, 'halo': halo, 'multiple': multiple}, f)
+
+    return quantized_path
+
+class QuantizedModel(object):
+    '''
+    quantized_path  int8 model written by quantize
+    threads         number of threads of the interpreter, 1 for one model per
+                    core
+    halo            pixels of context kept around the output of each window,
+                    the receptive radius of the network
+    multiple        windows start at multiples of multiple, see TILE_MULTIPLES
+    '''
+
+    def __init__(self, quantized_path, threads = 1, halo = 0, multiple = 1):
+
+        self.interpreter = tf.lite.Interpreter(model_path = quantized_path, num_threads = threads)
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        self.input = input_details['index']
+        self.output = output_details['index']
+        # input shape of the graph, and how much smaller its output is: 15
+        # pixels for the unpadded convolutions of DehazeNet, 0 for the others
+        self.window = tuple(int(n) for n in input_details['shape'][1:3])
+        self.shrink = tuple(int(n) for n in input_details['shape'][1:3] - output_details['shape'][1:3])
+        self.halo = halo
+        self.multiple = multiple
+
+    def invoke(self, window):
+        '''
+        Output of the graph on one image of exactly its input shape.
+        '''
+        self.interpreter.set_tensor(self.input, window[np.newaxis].astype(np.float32))
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self.output)[0]
+
+    def predict(self, hazy_input, batch_size = None):
+        '''
+        Output batch of the N * H * W * 3 hazy_input batch scaled to [0, 1],
+        as predict of the float model, computed one image at a time by
+        predict_image.
+        '''
+        return np.stack([self.predict_image(image) for image in hazy_input])
+
+    def spans(self, size, axis):
+        '''
+        (output start, window start, output length) of the windows covering
+        an input axis of the given size, a multiple of self.multiple. Each
+        window keeps the outputs at least halo pixels from its ends, except at
+        the ends of the axis.
+        '''
+        window = self.window[axis]
+        outputs = size - self.shrink[axis]
+        step = tile_step(window, self.shrink[axis], self.halo, self.multiple)
+
+        spans = []
+        for start in range(0, outputs, step):
+            origin = min(max(start - self.halo, 0), size - window) // self.multiple * self.multiple
+            spans.append((start, origin, min(step, outputs - start)))
+
+        return spans
+
+    def predict_image(self, image):
+        '''
+        Output of the graph on one H * W * 3 image of any size, pieced
+        together from windows of the conversion shape, so with halo the
+        receptive radius of the network it equals that of the float model on
+        the whole image. The image is edge padded to a multiple of multiple,
+        and to at least the window; the output is cropped back.
+        '''
+        height, width = image.shape[:2]
+        padded_height, padded_width = [max(-(-n // self.multiple) * self.multiple, window)
+                                       for n, window in zip((height, width), self.window)]
+        image = np.pad(image, ((0, padded_height - height), (0, padded_width - width), (0, 0)), 'edge')
+        if image.shape[:2] == self.window:
+            out = self.invoke(image)
+        else:
+            out = None
+            for y, Y, rows in self.spans(padded_height, 0):
+                for x, X, cols in self.spans(padded_width, 1):
+                    prediction = self.invoke(image[Y:Y + self.window[0], X:X + self.window[1]])
+                    if out is None:
+                        out = np.empty((padded_height - self.shrink[0], padded_width - self.shrink[1],
+                                        prediction.shape[-1]), prediction.dtype)
+                    out[y:y + rows, x:x + cols] = prediction[y - Y:y - Y + rows, x - X:x - X + cols]
+
+        return out[:height - self.shrink[0], :width - self.shrink[1]]
+
+def Load_model(quantized_path):
+    '''
+    QuantizedModel of quantized_path, tiled as written by quantize.
+    '''
+    try:
+        with open(quantized_path + '.json') as f:
+            tiling = json.load(f)
+    except FileNotFoundError:
+        tiling = {}
+
+    return QuantizedModel(quantized_path, halo = tiling.get('halo', 0), multiple = tiling.get('multiple', 1))
+
+def drift(architecture, weights, quantized_path, images):
+    '''
+    PSNR and SSIM of the images dehazed by the int8 model against those
+    dehazed by the float model, with Evaluate.PSNR and Evaluate.SSIM.
+    Returns the per-image PSNR and SSIM lists and prints their means.
+    '''
+    from Evaluate import PSNR, SSIM
+
+    module = importlib.import_module(ARCHITECTURES[architecture])
+    float_model = module.Load_model(weights)
+    int8_model = Load_model(quantized_path)
+
+    psnrs = []
+    ssims = []
+    for hazy_image in images:
+        float_dehazed = module.usemodel(float_model, hazy_image)
+        int8_dehazed = module.usemodel(int8_model, hazy_image)
+        psnrs.append(PSNR(float_dehazed, int8_dehazed))
+        ssims.append(SSIM(float_dehazed, int8_dehazed))
+
+    print('%s int8 drift: PSNR %.2f dB, SSIM %.4f' % (architecture, np.mean(psnrs), np.mean(ssims)))
+
+    return psnrs, ssims
+
+if __name__ =="__main__":
+
+    images_path = ''        # folder of hazy calibration images
+    weights = ''            # float weights, e.g. aodnet.h5
+    quantized_path = ''     # where to write the int8 model, e.g. aodnet_int8.tflite
+
+    import os
+    images = [cv2.imread(images_path + '/' + f) for f in os.listdir(images_path)]
+    quantize('AOD', weights, images, quantized_path)
+    drift('AOD', weights, quantized_path, images)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+'''
+Index-addressable training batches for fit_generator.
+
+Unlike a generator of batches, a keras.utils.Sequence can be read by
+several loader threads at once, so with fit_generator(workers = n) images
+are decoded in parallel and ahead of the training steps, up to
+max_queue_size batches. Batches are written into a ring of reused buffers
+instead of freshly allocated arrays.
+'''
+import shards
+import threading
+import numpy as np
+
+from keras.utils import Sequence
+from synthetic import HazeGenerator
+
+class BufferedSequence(Sequence):
+    '''
+    Base of the sequences below: a ring of batch buffers and per-epoch
+    reshuffling of the order of the items.
+
+    buffers  number of batches in the ring; it must exceed the number of
+             batches alive at once, max_queue_size + workers + 1 for
+             fit_generator, or a batch would be overwritten in use
+    '''
+
+    def __init__(self, items, shuffle = True, seed = 0, buffers = 16):
+
+        self.items = items if isinstance(items, np.ndarray) else list(items)
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.ring = [None] * buffers
+        self.next_buffer = 0
+        self.lock = threading.Lock()
+        if shuffle:
+            self.random.shuffle(self.items)
+
+    def on_epoch_end(self):
+
+        if self.shuffle:
+            self.random.shuffle(self.items)
+
+    def buffer(self, n, data_shape, label_shape):
+        '''
+        (data, label) float buffers for a batch of n samples, the next ones of
+        the ring, grown if they are too small.
+        '''
+        with self.lock:
+            slot = self.next_buffer
+            self.next_buffer = (slot + 1) % len(self.ring)
+
+        data, label = self.ring[slot] or (None, None)
+        if data is None or len(data) < n or data.shape[1:] != data_shape or label.shape[1:] != label_shape:
+            data = np.empty((n,) + data_shape)
+            label = np.empty((n,) + label_shape)
+            self.ring[slot] = (data, label)
+
+        return data[:n], label[:n]
+
+    def scale(self, data, target):
+        '''
+        The uint8 batch (data, target), with self.labels applied to target if
+        set, scaled to [0, 1] into the next buffers of the ring.
+        '''
+        if self.labels is not None:
+            target = self.labels(target)
+        x, y = self.buffer(len(data), data.shape[1:], target.shape[1:])
+        np.divide(data, 255.0, out = x)
+        np.divide(target, 255.0, out = y)
+
+        return x, y
+
+def stack(samples):
+    '''
+    (data, label) batch arrays of an iterable of (hazy, label) samples
+    '''
+    data, label = zip(*samples)
+
+    return np.stack(data), np.stack(label)
+
+class SampleSequence(BufferedSequence):
+    '''
+    Batches decoded from a list of files, scaled to [0, 1].
+
+    files            hazy image files
+    load             function from a list of files to their (data, label)
+                     uint8 batch arrays, e.g. stack of the samples function
+                     of a network module
+    files_per_batch  number of files decoded per batch
+    labels           function applied to the label batch, e.g. the means of
+                     transmission patches for DehazeNet; None keeps it
+    '''
+
+    def __init__(self, files, load, files_per_batch, labels = None, shuffle = True, seed = 0, buffers = 16):
+
+        super(SampleSequence, self).__init__(files, shuffle, seed, buffers)
+        self.load = load
+        self.files_per_batch = files_per_batch
+        self.labels = labels
+
+    def __len__(self):
+
+        return -(-len(self.items) // self.files_per_batch)
+
+    def __getitem__(self, index):
+
+        files = self.items[index * self.files_per_batch : (index + 1) * self.files_per_batch]
+
+        return self.scale(*self.load(files))
+
+class ShardSequence(BufferedSequence):
+    '''
+    Batches of at most batch_size samples read from the memory-mapped shards
+    in shard_path (see shards.py), scaled to [0, 1]. Batches do not span
+    shards; reshuffling changes the order of the batches, not their content,
+    so every batch stays one contiguous read.
+    '''
+
+    def __init__(self, shard_path, batch_size, labels = None, shuffle = True, seed = 0, buffers = 16):
+
+        self.shards = shards.open_shards(shard_path)
+        batches = [(k, start) for k, (data, _) in enumerate(self.shards)
+                   for start in range(0, len(data), batch_size)]
+        super(ShardSequence, self).__init__(batches, shuffle, seed, buffers)
+        self.batch_size = batch_size
+        self.labels = labels
+
+    def __len__(self):
+
+        return len(self.items)
+
+    def __getitem__(self, index):
+
+        k, start = self.items[index]
+        data, target = self.shards[k]
+
+        return self.scale(data[start : start + self.batch_size], target[start : start + self.batch_size])
+
+class RandomShardSequence(BufferedSequence):
+    '''
+    Batches of batch_size samples drawn uniformly without replacement from
+    all the shards in shard_path, with a new permutation every epoch, so each
+    batch mixes samples of many images, e.g. DehazeNet patches of many
+    scenes. The samples of a batch are read in file order.
+    '''
+
+    def __init__(self, shard_path, batch_size, labels = None, seed = 0, buffers = 16):
+
+        self.shards = shards.open_shards(shard_path)
+        self.offsets = np.cumsum([0] + [len(data) for data, _ in self.shards])
+        super(RandomShardSequence, self).__init__(np.arange(self.offsets[-1]), True, seed, buffers)
+        self.batch_size = batch_size
+        self.labels = labels
+
+    def __len__(self):
+
+        return -(-len(self.items) // self.batch_size)
+
+    def __getitem__(self, index):
+
+        picked = np.sort(self.items[index * self.batch_size : (index + 1) * self.batch_size])
+        owner = np.searchsorted(self.offsets, picked, side = 'right') - 1
+        data = np.empty((len(picked),) + self.shards[0][0].shape[1:], np.uint8)
+        target = np.empty((len(picked),) + self.shards[0][1].shape[1:], np.uint8)
+        for k in np.unique(owner):
+            rows = owner == k
+            data[rows] = self.shards[k][0][picked[rows] - self.offsets[k]]
+            target[rows] = self.shards[k][1][picked[rows] - self.offsets[k]]
+
+        return self.scale(data, target)
+
+def image_sequence(samples, data_path, label_path, data_files, pairs, batch_size, height, width,
+                   shuffle = True, buffers = 16):
+    '''
+    SampleSequence of the images data_files decoded by samples, the function
+    of a network module yielding the (hazy, label) uint8 pairs of images
+    resized to height * width, reshuffled every epoch if shuffle
+    '''
+    return SampleSequence(data_files, lambda files: stack(samples(data_path, label_path, files, pairs, height, width)),
+                          batch_size, shuffle = shuffle, buffers = buffers)
+
+def image_shard_sequence(samples, data_path, label_path, data_files, pairs, shard_path, batch_size, height, width,
+                         shuffle = True, buffers = 16):
+    '''
+    image_sequence read from preprocessed shards in shard_path, written there
+    first unless they already hold data_files at this size
+    '''
+    shards.ensure_shards(samples(data_path, label_path, data_files, pairs, height, width),
+                         shard_path, files = list(data_files), height = height, width = width)
+
+    return ShardSequence(shard_path, batch_size, shuffle = shuffle, buffers = buffers)
+
+def haze_sequence(clear_path, depth_path, clear_files, pairs, batch_size, height, width, target, copies = 1,
+                  shuffle = True, buffers = 16):
+    '''
+    SampleSequence of batches hazed on the fly from the clear images in
+    clear_path and their depth maps in depth_path, labelled with the clear
+    images or the transmission maps as target is 'clear' or 'trans' (see
+    synthetic.HazeGenerator). Every clear image appears copies times per
+    epoch, each time with new random haze; without shuffle, as for
+    validation, each image is hazed the same way every epoch.
+    '''
+    haze = HazeGenerator(clear_path, depth_path, pairs, height, width, target, fixed = not shuffle)
+
+    return SampleSequence(list(clear_files) * copies, haze, batch_size, shuffle = shuffle, buffers = buffers)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+'''
+Preprocessed training data in memory-mapped uint8 shards.
+
+The (hazy, label) samples of a training set are decoded and resized once
+and written to shard_path as shard_00000_data.npy, shard_00000_label.npy,
+... plus index.json. Training then reads batches straight from the memory
+mapped shards (sequence.ShardSequence and RandomShardSequence), so an epoch
+costs no JPEG decoding or resizing.
+'''
+import os
+import json
+import numpy as np
+
+def write_shards(samples, shard_path, shard_bytes = 256 << 20, **meta):
+    '''
+    Write an iterable of (hazy, label) uint8 sample pairs to shards of about
+    shard_bytes bytes each in the folder shard_path. All hazy samples must
+    have one shape, and all labels another. meta is stored in the index.
+    Returns the index.
+    '''
+    os.makedirs(shard_path, exist_ok = True)
+    index = dict(meta, shards = [], count = 0)
+    data = label = None
+    n = 0
+
+    def flush():
+        name = 'shard_%05d' % len(index['shards'])
+        np.save(os.path.join(shard_path, name + '_data.npy'), data[:n])
+        np.save(os.path.join(shard_path, name + '_label.npy'), label[:n])
+        index['shards'].append({'name': name, 'count': n})
+        index['count'] += n
+
+    for hazy, target in samples:
+        if data is None:
+            size = max(1, shard_bytes // (hazy.nbytes + target.nbytes))
+            data = np.empty((size,) + hazy.shape, np.uint8)
+            label = np.empty((size,) + target.shape, np.uint8)
+            index['data_shape'] = list(hazy.shape)
+            index['label_shape'] = list(target.shape)
+        data[n] = hazy
+        label[n] = target
+        n += 1
+        if n == len(data):
+            flush()
+            n = 0
+    if n:
+        flush()
+
+    with open(os.path.join(shard_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+def ensure_shards(samples, shard_path, **meta):
+    '''
+    write_shards unless shard_path already holds shards written with the same
+    meta, e.g. the same file list and sample size. samples is only consumed
+    if the shards are (re)written. Returns the index.
+    '''
+    index = read_index(shard_path)
+    if index is None or any(index.get(key) != value for key, value in meta.items()):
+        index = write_shards(samples, shard_path, **meta)
+
+    return index
+
+def read_index(shard_path):
+    '''
+    The index of the shards in shard_path, or None if there are none yet.
+    '''
+    try:
+        with open(os.path.join(shard_path, 'index.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def open_shards(shard_path):
+    '''
+    [(data, label)] memory maps of the shards in shard_path.
+    '''
+    return [(np.load(os.path.join(shard_path, shard['name'] + '_data.npy'), mmap_mode = 'r'),
+             np.load(os.path.join(shard_path, shard['name'] + '_label.npy'), mmap_mode = 'r'))
+            for shard in read_index(shard_path)['shards']]
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+Hazy training images synthesized at load time from clear images and depth.
+
+Instead of storing many pre-rendered hazy copies of every clear image, each
+batch is hazed on the fly with the atmospheric scattering model
+
+    I = J * t + A * (1 - t),    t = exp(-beta * d)
+
+with the scattering coefficient beta and the atmospheric light A drawn at
+random per image, so every epoch sees new haze and only the clear images and
+their depth maps are kept on disk.
+'''
+import cv2
+import zlib
+import threading
+import numpy as np
+
+# ranges beta and A are drawn from, those RESIDE ITS was rendered with
+BETA = (0.6, 1.8)
+AIRLIGHT = (0.7, 1.0)
+
+def transmission(depth, beta):
+    '''
+    t = exp(-beta * d) of a batch of n depth maps, one beta per map
+    '''
+    return np.exp(-np.asarray(beta, np.float64).reshape(-1, 1, 1) * depth)
+
+def scatter(clear, t, A):
+    '''
+    Hazy batch I = J * t + A * (1 - t) of the n * H * W * 3 clear batch J
+    scaled to [0, 1], the n * H * W transmission t and the atmospheric light
+    A, one value or one per channel for each image.
+    '''
+    A = np.asarray(A, np.float64).reshape(len(clear), 1, 1, -1)
+    t = t[:, :, :, np.newaxis]
+
+    return clear * t + A * (1 - t)
+
+def to_uint8(x):
+    '''
+    x in [0, 1] rounded to uint8 like a stored image
+    '''
+    return np.clip(np.rint(x * 255.0), 0, 255).astype(np.uint8)
+
+def load_depth(depth_file, depth_scale = 1.0):
+    '''
+    Depth map in the .npy file or image file depth_file, multiplied by
+    depth_scale, e.g. 0.001 for a 16 bit PNG in millimetres.
+    '''
+    if depth_file.endswith('.npy'):
+        depth = np.load(depth_file)
+    else:
+        depth = cv2.imread(depth_file, cv2.IMREAD_UNCHANGED)
+
+    return depth.astype(np.float32) * depth_scale
+
+class HazeGenerator(object):
+    '''
+    Function from a list of clear image files to a batch of hazy images and
+    their labels, both uint8.
+
+    clear_path   folder of the clear images
+    depth_path   folder of their depth maps, in metres after depth_scale
+    pairs        {clear file: depth file}, e.g. pairing.pair_files(clear_path,
+                 depth_path, 'same')
+    height       size every image is resized to, so that a batch is one array
+    width
+    target       'clear' for the clear image label of AOD-Net, 'trans' for the
+                 height * width * 1 transmission label of MSCNN and DehazeNet
+    beta         (low, high) range of the scattering coefficient
+    airlight     (low, high) range of the atmospheric light, grey
+    fixed        draw beta and A from the file name rather than at random, so
+                 that a validation set is hazed the same way every epoch
+    '''
+
+    def __init__(self, clear_path, depth_path, pairs, height, width, target = 'clear',
+                 beta = BETA, airlight = AIRLIGHT, depth_scale = 1.0, fixed = False, seed = 0):
+
+        self.clear_path = clear_path
+        self.depth_path = depth_path
+        self.pairs = pairs
+        self.height = height
+        self.width = width
+        self.target = target
+        self.beta = beta
+        self.airlight = airlight
+        self.depth_scale = depth_scale
+        self.fixed = fixed
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+
+    def load(self, files):
+        '''
+        uint8 clear images and float depth maps of files, resized
+        '''
+        clear = np.empty((len(files), self.height, self.width, 3), np.uint8)
+        depth = np.empty((len(files), self.height, self.width), np.float32)
+        for i, clear_file in enumerate(files):
+            clear[i] = cv2.resize(cv2.imread(self.clear_path + '/' + clear_file), (self.width, self.height),
+                                  interpolation = cv2.INTER_AREA)
+            depth[i] = cv2.resize(load_depth(self.depth_path + '/' + self.pairs[clear_file], self.depth_scale),
+                                  (self.width, self.height), interpolation = cv2.INTER_LINEAR)
+
+        return clear, depth
+
+    def parameters(self, files):
+        '''
+        beta and A of each file
+        '''
+        if self.fixed:
+            draws = [np.random.RandomState(zlib.crc32(f.encode('utf8')) ^ self.seed).uniform(size = 2)
+                     for f in files]
+            u = np.array(draws).reshape(len(files), 2)
+        else:
+            with self.lock:
+                u = self.random.uniform(size = (len(files), 2))
+
+        beta = self.beta[0] + u[:, 0] * (self.beta[1] - self.beta[0])
+        A = self.airlight[0] + u[:, 1] * (self.airlight[1] - self.airlight[0])
+
+        return beta, A
+
+    def __call__(self, files):
+
+        clear, depth = self.load(files)
+        beta, A = self.parameters(files)
+        t = transmission(depth, beta)
+        hazy = to_uint8(scatter(clear / 255.0, t, A))
+
+        if self.target == 'clear':
+            return hazy, clear
+        return hazy, to_uint8(t)[:, :, :, np.newaxis]